@@ -0,0 +1,73 @@
+import threading
+
+# Characters added between two cues in a batch ('\n\n')
+SEPARATOR_LENGTH = 2
+
+
+class BatchBuilder:
+    def __init__(self, char_budget=1500, min_budget=200, max_budget=6000, adaptive=True, target_latency=15.0):
+        # char_budget is the number of source characters packed into one request (about four characters per token)
+        self.char_budget = char_budget
+        self.min_budget = min_budget
+        self.max_budget = max_budget
+        # When adaptive is True the budget is tuned from the observed latency and validation failures
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+
+        # Exponential moving averages of the validation failure rate and the request latency in seconds
+        self.failure_rate = 0.0
+        self.latency = 0.0
+        self.observations = 0
+        self.lock = threading.Lock()
+
+    def iter_batches(self, rows, max_cues):
+        # Pack consecutive rows into batches of at most char_budget characters and max_cues rows
+        # The budget is read for every batch, so batches built later follow the latest tuning
+        batch = []
+        batch_chars = 0
+        for row in rows:
+            row_chars = len(row[1]) + (SEPARATOR_LENGTH if batch else 0)
+            if batch and (batch_chars + row_chars > self.char_budget or len(batch) >= max_cues):
+                yield batch
+                batch = []
+                batch_chars = 0
+                row_chars = len(row[1])
+
+            # A single cue longer than the budget still gets a batch of its own
+            batch.append(row)
+            batch_chars += row_chars
+
+        if batch:
+            yield batch
+
+    def record(self, latency, valid, smoothing=0.2):
+        # Update the averages with the result of one request and adjust the budget
+        with self.lock:
+            self.observations += 1
+            failed = 0.0 if valid else 1.0
+            if self.observations == 1:
+                self.failure_rate = failed
+                self.latency = latency
+            else:
+                self.failure_rate += smoothing * (failed - self.failure_rate)
+                self.latency += smoothing * (latency - self.latency)
+
+            if not self.adaptive:
+                return
+
+            # Shrink the batches when the model starts breaking them or requests get slow,
+            # and grow them again while they validate and come back quickly
+            if self.failure_rate > 0.2:
+                budget = self.char_budget * 0.75
+            elif self.latency > self.target_latency:
+                budget = self.char_budget * 0.85
+            elif self.failure_rate < 0.05:
+                budget = self.char_budget * 1.1
+            else:
+                budget = self.char_budget
+            self.char_budget = int(min(max(budget, self.min_budget), self.max_budget))
+
+    def report(self):
+        # Summarize the current budget and the averages it was tuned from
+        return (f"Batch budget: {self.char_budget} characters "
+                f"(failure rate {self.failure_rate * 100:.1f}%, latency {self.latency:.2f} s).")
@@ -0,0 +1,101 @@
+import re
+
+# A line holding only the subtitle index in brackets starts each subtitle of a tagged batch, e.g. "[12]"
+MARKER_RE = re.compile(r'^[ \t]*\[(\d+)\][ \t]*$', re.MULTILINE)
+
+
+def encode_batch(rows):
+    # Put each subtitle under a marker line with its index, so the reply can be matched back cue by cue
+    return '\n\n'.join(f"[{subtitle_index}]\n{text}" for subtitle_index, text in rows)
+
+
+def parse_batch(translated_text):
+    # Read the reply in a single pass into {subtitle_index: text}
+    # A marker that appears twice keeps its first text, as the later one is most likely a repetition
+    translations = {}
+    matches = list(MARKER_RE.finditer(translated_text))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(translated_text)
+        subtitle_index = int(match.group(1))
+        if subtitle_index not in translations:
+            translations[subtitle_index] = translated_text[match.end():end].strip()
+    return translations
+
+
+def is_cue_translation_valid(text):
+    # A translated subtitle must not be empty and may have at most three lines
+    return bool(text) and text.count('\n') <= 2
+
+
+def decode_batch(translated_text, rows):
+    # Split the reply into accepted (subtitle_index, text) pairs and the rows that have to be sent again
+    translations = parse_batch(translated_text or '')
+    results = []
+    missing_rows = []
+    for row in rows:
+        text = translations.get(row[0])
+        if text is not None:
+            # Blank lines inside a subtitle would break the SRT file, so they are removed
+            text = '\n'.join(line for line in text.split('\n') if line.strip())
+        if text is not None and is_cue_translation_valid(text):
+            results.append((row[0], text))
+        else:
+            missing_rows.append(row)
+    return results, missing_rows
+
+
+def decode_list(translated_texts, rows):
+    # Same as decode_batch for providers that return one translation per row, in the order of the rows
+    if not translated_texts or len(translated_texts) != len(rows):
+        return [], list(rows)
+    results = []
+    missing_rows = []
+    for row, text in zip(rows, translated_texts):
+        text = '\n'.join(line for line in (text or '').split('\n') if line.strip())
+        if is_cue_translation_valid(text):
+            results.append((row[0], text))
+        else:
+            missing_rows.append(row)
+    return results, missing_rows
+
+
+def is_translation_valid(original, translated):
+    # Split the original and translated text by double newlines to get blocks
+    original_blocks = original.split('\n\n')
+    translated_blocks = translated.split('\n\n')
+
+    # Check if the number of blocks in both texts are equal
+    if len(original_blocks) != len(translated_blocks):
+        return False
+
+    # Ensure that each translated block has no more than two newlines
+    for trans_block in translated_blocks:
+        trans_line_count = trans_block.count('\n')
+        if trans_line_count > 2:
+            return False
+
+    # Return True if the translation is considered valid
+    return True
+
+
+def encode_rows(rows, batch_format):
+    # The request for the rows in a batch format: 'list' is the list of texts for services that translate lists,
+    # 'tagged' puts every subtitle under its [index] marker and 'plain' joins the texts with blank lines
+    if batch_format == 'list':
+        return [row[1] for row in rows]
+    if batch_format == 'tagged':
+        return encode_batch(rows)
+    return '\n\n'.join(row[1] for row in rows)
+
+
+def decode_reply(reply, rows, batch_format):
+    # Split the reply to encode_rows(rows, batch_format) into accepted (subtitle_index, text) pairs and the rows
+    # that have to be sent again; a 'plain' reply is only accepted as a whole
+    if batch_format == 'list':
+        return decode_list(reply, rows)
+    if batch_format == 'tagged':
+        return decode_batch(reply, rows)
+    if reply and is_translation_valid(encode_rows(rows, 'plain'), reply):
+        # Pair each translated block with the subtitle index it belongs to
+        return [(rows[i][0], block) for i, block in enumerate(reply.split('\n\n'))], []
+    return [], list(rows)
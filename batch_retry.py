@@ -0,0 +1,64 @@
+from colorama import Fore, Style
+from rate_limiter import FatalProviderError
+
+# The retries of a batch, shared by the Translator and the streaming mode: a reply that fails validation is
+# sent again or split in halves to isolate the subtitles that break it, while an error from the service fails
+# the batch at once.
+
+# Attempts for a batch that can no longer be split
+MAX_ATTEMPTS = 5
+
+
+def translate_with_retries(request, rows, max_attempts=MAX_ATTEMPTS, bisect=True, calls=None, label=''):
+    # Translate the rows and return (results, failed_rows); used by the Translator and the streaming mode.
+    # request(rows, attempt) sends the rows once and returns (results, missing_rows, replied), where replied is
+    # False when the service returned an error instead of a reply; a FatalProviderError stops the retries too.
+    # calls[0] counts the requests made and label is added to the messages, e.g. " (fi)".
+    results = []
+
+    # Try translating the batch until successful or max attempts are reached
+    # Accepted rows are kept and only the missing ones are sent again
+    attempt = 0
+    while rows:
+        # When bisecting, a batch of several rows gets a single attempt before it is split,
+        # so only the rows that cause the failure are retried
+        split = bisect and len(rows) > 1
+        if attempt >= (1 if split else max_attempts):
+            break
+
+        attempt += 1
+        if calls is not None:
+            calls[0] += 1
+        try:
+            accepted, rows, replied = request(rows, attempt)
+        except FatalProviderError as e:
+            # A bad key, an exhausted quota or a rejected request fails the same way every time
+            print(f"Error translating lines {rows[0][0]}-{rows[-1][0]}{label}: {e}. Not trying again.")
+            return results, rows
+        results.extend(accepted)
+        if not replied:
+            # The service returned an error after its own retries with backoff; splitting the batch or
+            # sending it again would only repeat the error, so the rows are failed as they are
+            print(f"The translation service returned an error for lines {rows[0][0]}-{rows[-1][0]}{label}. "
+                  f"Adding to the list of failures.")
+            return results, rows
+
+    if not rows:
+        return results, []
+
+    first_index = rows[0][0]
+    last_index = rows[-1][0]
+    if bisect and len(rows) > 1:
+        # Translate each half on its own; halves that validate are kept
+        middle = len(rows) // 2
+        print(f"Splitting lines {first_index}-{last_index}{label} to isolate the failure.")
+        first_results, first_failed = translate_with_retries(request, rows[:middle], max_attempts, bisect, calls,
+                                                             label)
+        second_results, second_failed = translate_with_retries(request, rows[middle:], max_attempts, bisect, calls,
+                                                               label)
+        return results + first_results + second_results, first_failed + second_failed
+
+    # All attempts failed
+    print(
+        f"All translation attempts " + Fore.RED + "failed" + Style.RESET_ALL + f" for lines {first_index}-{last_index}{label}. Adding to the list of failures.")
+    return results, rows
@@ -0,0 +1,216 @@
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dotenv import load_dotenv
+from providers import provider_names
+from rate_limiter import share_rate_limits
+
+# Folders created by the translator next to the source files; their contents are never used as input
+GENERATED_FOLDERS = ("Subtitle Database", "Translations")
+
+
+def expand_paths(paths):
+    # Turn files, glob patterns and directories into a sorted list of SRT files
+    files = set()
+    for path in paths:
+        if glob.has_magic(path):
+            matches = glob.glob(path, recursive=True)
+        else:
+            matches = [path]
+
+        for match in matches:
+            if os.path.isdir(match):
+                for folder, subfolders, file_names in os.walk(match):
+                    # Skip the folders the translator writes to
+                    subfolders[:] = [name for name in subfolders if name not in GENERATED_FOLDERS]
+                    files.update(os.path.join(folder, name) for name in file_names if name.lower().endswith('.srt'))
+            elif os.path.isfile(match):
+                files.add(match)
+            else:
+                print(f"No such file or directory: {match}")
+    return sorted(files)
+
+
+def init_worker(workers):
+    # Runs once in every worker process: the rate limits of the accounts are split between the processes,
+    # since each one has its own schedulers. The .env file is read first, as the limits may be set there.
+    load_dotenv()
+    share_rate_limits(workers)
+
+
+def translate_file(file_path, options):
+    # Translate one file from start to finish without asking anything; runs in a worker process
+    from translator_class import Translator
+
+    result = {"file": file_path, "translated": 0, "failed": 0, "seconds": 0.0, "error": None, "job": None}
+    start_time = time.perf_counter()
+    translator = None
+    try:
+        translator = Translator(file_path, batch_size=options["batch_size"],
+                                overwrite_translations=options["overwrite"], concurrency=options["concurrency"],
+                                use_cache=options["use_cache"], target_langs=options["target_langs"],
+                                char_budget=options["char_budget"], adaptive_batching=options["adaptive_batching"],
+                                batch_format=options["batch_format"], metrics=options["metrics_dir"] is not None,
+                                scene_gap=options["scene_gap"], scene_max_cues=options["scene_max_cues"],
+                                fuzzy_threshold=options["fuzzy_threshold"], qa=options["qa"])
+        translator.translation_service = options["service"]
+
+        # Translate the whole file unless a range was given
+        index_range = options["index_range"]
+        if index_range is None:
+            max_index = translator.database_manager.get_max_subtitle_index()
+            if max_index is None:
+                raise ValueError("the file has no subtitles")
+            index_range = f"1-{max_index}"
+        translator.set_parameters(index_range, options["batch_size"], options["overwrite"])
+
+        translated_before = sum(translator.database_manager.get_translated_count(target_lang)
+                                for target_lang in translator.target_langs)
+        if options["batch_api"]:
+            # Rows a finished job could not translate stay untranslated and are picked up by the next run
+            result["job"] = translator.run_batch_job(options["overwrite"], wait_for_results=options["wait"],
+                                                     poll_interval=options["poll_interval"])
+            failed = []
+        else:
+            failed = translator.process_srt(options["overwrite"], retry_failed=options["retry_failed"])
+        translated_after = sum(translator.database_manager.get_translated_count(target_lang)
+                               for target_lang in translator.target_langs)
+
+        result["translated"] = max(translated_after - translated_before, 0)
+        result["failed"] = len(failed)
+
+        # Write the run report and Prometheus textfile for this file
+        if options["metrics_dir"] is not None:
+            report_name = os.path.join(options["metrics_dir"], translator.movie_name)
+            translator.export_metrics(report_name + ".metrics.json", report_name + ".prom")
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        if translator is not None:
+            translator.close()
+        result["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+def print_summary(results, elapsed):
+    # Print one line per file and the totals for the whole run
+    print("\nSummary:")
+    for result in results:
+        if result["error"]:
+            status = f"error: {result['error']}"
+        elif result["job"]:
+            status = f"batch job {result['job']} still running"
+        else:
+            status = f"{result['translated']} translated, {result['failed']} failed"
+        print(f"  {result['file']}: {status} ({result['seconds']:.1f} s)")
+
+    translated = sum(result["translated"] for result in results)
+    failed_cues = sum(result["failed"] for result in results)
+    failed_files = sum(1 for result in results if result["error"] or result["failed"])
+    rate = translated / elapsed if elapsed > 0 else 0
+    print(f"\n{len(results)} files, {failed_files} with failures, {translated} subtitles translated, "
+          f"{failed_cues} failed, {elapsed:.1f} s ({rate:.1f} subtitles/s).")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Translate SRT files, globs or whole directories without prompts.")
+    parser.add_argument("paths", nargs="+", help="SRT files, glob patterns or directories")
+    parser.add_argument("-t", "--target-lang", required=True,
+                        help="target language code, or several separated by commas, e.g. fi,sv,nb")
+    parser.add_argument("-s", "--service", choices=provider_names(), default="deepl",
+                        help="translation service (default deepl)")
+    parser.add_argument("-b", "--batch-size", type=int, default=20,
+                        help="maximum subtitles per request (default 20)")
+    parser.add_argument("--char-budget", type=int, default=1500,
+                        help="starting number of source characters per request, tuned during the run (default 1500)")
+    parser.add_argument("--fixed-budget", action="store_true", help="do not tune the character budget")
+    parser.add_argument("--plain-batches", action="store_true",
+                        help="send batches without [index] markers and accept replies only as a whole")
+    parser.add_argument("--scene-gap", type=float, default=3.0,
+                        help="pause in seconds that starts a new scene; scenes are translated in parallel "
+                             "and context stays within a scene, 0 turns scenes off (default 3)")
+    parser.add_argument("--scene-max-cues", type=int, default=100,
+                        help="split scenes longer than this many subtitles at their longest pause (default 100)")
+    parser.add_argument("-r", "--range", dest="index_range",
+                        help="index ranges to translate, e.g. '1-50,60-70' (default: the whole file)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of files translated at the same time")
+    parser.add_argument("-c", "--max-requests", type=int, default=8,
+                        help="maximum number of requests in flight across all files (default 8)")
+    parser.add_argument("--overwrite", action="store_true", help="replace existing translations")
+    parser.add_argument("--no-retry", action="store_true", help="do not retry failed translations one by one")
+    parser.add_argument("--no-cache", action="store_true", help="do not use the shared translation cache")
+    parser.add_argument("--fuzzy-threshold", type=float, default=0.7,
+                        help="smallest similarity (0-1) at which a cached subtitle counts as a near match; near "
+                             "matches are reused or sent to OpenAI as examples, 0 turns this off (default 0.7)")
+    parser.add_argument("--no-qa", action="store_true",
+                        help="skip the QA pass that translates subtitles with reading speed, line length or "
+                             "missing translation problems again")
+    parser.add_argument("--batch-api", action="store_true",
+                        help="translate with an OpenAI Batch API job; running the command again resumes the job")
+    parser.add_argument("--no-wait", action="store_true",
+                        help="with --batch-api, submit or check the job and return instead of waiting for it")
+    parser.add_argument("--poll-interval", type=float, default=30,
+                        help="seconds between batch job status checks (default 30)")
+    parser.add_argument("--metrics-dir",
+                        help="record per-stage timings and write a JSON report and Prometheus textfile per file here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.batch_api and args.service != "openai":
+        print("--batch-api needs --service openai.")
+        return 1
+    files = expand_paths(args.paths)
+    if not files:
+        print("No SRT files found.")
+        return 1
+
+    # Split the global request limit between the worker processes
+    workers = max(1, min(args.workers, len(files), args.max_requests))
+    options = {
+        "target_langs": [lang.strip() for lang in args.target_lang.split(',') if lang.strip()],
+        "service": args.service,
+        "batch_size": args.batch_size,
+        "char_budget": args.char_budget,
+        "adaptive_batching": not args.fixed_budget,
+        "batch_format": "plain" if args.plain_batches else "tagged",
+        "scene_gap": args.scene_gap,
+        "scene_max_cues": args.scene_max_cues,
+        "metrics_dir": args.metrics_dir,
+        "index_range": args.index_range,
+        "overwrite": args.overwrite,
+        "retry_failed": not args.no_retry,
+        "use_cache": not args.no_cache,
+        "fuzzy_threshold": args.fuzzy_threshold,
+        "qa": not args.no_qa,
+        "batch_api": args.batch_api,
+        "wait": not args.no_wait,
+        "poll_interval": args.poll_interval,
+        "concurrency": max(1, args.max_requests // workers),
+    }
+    print(f"Translating {len(files)} files with {workers} workers, "
+          f"{options['concurrency']} requests per worker.")
+
+    if args.metrics_dir and not os.path.exists(args.metrics_dir):
+        os.makedirs(args.metrics_dir)
+
+    start_time = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(workers,)) as executor:
+        futures = [executor.submit(translate_file, file_path, options) for file_path in files]
+        for future in as_completed(futures):
+            results.append(future.result())
+
+    results.sort(key=lambda result: result["file"])
+    print_summary(results, time.perf_counter() - start_time)
+
+    # Exit with an error code if anything failed, so scheduled runs can notice
+    return 1 if any(result["error"] or result["failed"] for result in results) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
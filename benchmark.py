@@ -0,0 +1,169 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from srt_parser import ms_to_timestamp
+
+# Words and lines used to build synthetic subtitles; the short lines repeat like real dialogue does
+WORDS = ("the", "you", "we", "have", "to", "go", "now", "what", "is", "this", "I", "don't", "know", "where",
+         "he", "she", "it", "was", "never", "here", "before", "tell", "me", "about", "night", "house", "car",
+         "money", "again", "why", "did", "they", "come", "back", "look", "at", "that", "right", "maybe", "later")
+COMMON_LINES = ("What?", "Thank you.", "Let's go!", "Yeah.", "No.", "Come on.", "I'm sorry.", "Okay.")
+
+# DatabaseManager methods that are timed as SQLite time
+DATABASE_METHODS = ("create_table", "check_if_table_exists", "check_if_data_exists", "save_many_to_db",
+                    "migrate_legacy_translations", "fetch_rows_to_translate", "get_translation_from_index",
+                    "get_last_translated_index", "get_max_subtitle_index", "update_database",
+                    "claim_rows", "finish_batch", "release_leases", "get_failed_translations",
+                    "save_translations_to_srt")
+
+
+def generate_srt(file_path, cue_count, seed=0):
+    # Write a synthetic SRT file with cue_count subtitles of one or two lines
+    generator = random.Random(seed)
+    start_ms = 1000
+    with open(file_path, 'w', encoding='utf-8') as file:
+        for index in range(1, cue_count + 1):
+            if generator.random() < 0.15:
+                text = generator.choice(COMMON_LINES)
+            else:
+                lines = [' '.join(generator.choice(WORDS) for _ in range(generator.randint(2, 8))).capitalize() + '.'
+                         for _ in range(generator.randint(1, 2))]
+                text = '\n'.join(lines)
+            end_ms = start_ms + generator.randint(800, 4000)
+            file.write(f"{index}\n{ms_to_timestamp(start_ms)} --> {ms_to_timestamp(end_ms)}\n{text}\n\n")
+            # Leave a longer gap now and then, like a scene change
+            start_ms = end_ms + (generator.randint(3000, 10000) if generator.random() < 0.05 else
+                                 generator.randint(50, 800))
+
+
+def time_database_methods(timings):
+    # Wrap the DatabaseManager methods so the time spent in them is added to timings['sqlite']
+    from db_func import DatabaseManager
+
+    def timed(method):
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timings['sqlite'] += time.perf_counter() - start_time
+        return wrapper
+
+    for name in DATABASE_METHODS:
+        setattr(DatabaseManager, name, timed(getattr(DatabaseManager, name)))
+
+
+def run_scenario(scenario):
+    # Run the full pipeline for one file size in this process and return the measurements
+    import builtins
+    import mock_translator
+    from translator_class import Translator
+
+    # Keep the pipeline's progress messages out of the results
+    if scenario["quiet"]:
+        builtins.print = lambda *args, **kwargs: None
+
+    timings = {'sqlite': 0.0}
+    time_database_methods(timings)
+    provider = mock_translator.configure(latency=scenario["latency"], error_rate=scenario["error_rate"],
+                                         malformed_rate=scenario["malformed_rate"], seed=scenario["seed"])
+
+    with tempfile.TemporaryDirectory() as folder:
+        file_path = os.path.join(folder, "benchmark.en.srt")
+        generate_srt(file_path, scenario["cues"], scenario["seed"])
+
+        start_time = time.perf_counter()
+        translator = Translator(file_path, scenario["target_lang"], batch_size=scenario["batch_size"],
+                                concurrency=scenario["concurrency"], use_cache=False)
+        ingest_seconds = time.perf_counter() - start_time
+
+        translator.translation_service = 'mock'
+        translator.set_parameters(f"1-{scenario['cues']}", scenario["batch_size"], False)
+        process_start = time.perf_counter()
+        failed = translator.process_srt(False, retry_failed=True)
+        process_seconds = time.perf_counter() - process_start
+        translator.close()
+
+    total_seconds = time.perf_counter() - start_time
+    stats = provider.stats()
+    return {
+        "cues": scenario["cues"],
+        "seconds": round(total_seconds, 4),
+        "ingest_seconds": round(ingest_seconds, 4),
+        "translate_seconds": round(process_seconds, 4),
+        "sqlite_seconds": round(timings['sqlite'], 4),
+        "cues_per_second": round(scenario["cues"] / total_seconds, 2),
+        "api_calls": stats["calls"],
+        "api_calls_per_cue": round(stats["calls"] / scenario["cues"], 4),
+        "provider_errors": stats["errors"],
+        "malformed_responses": stats["malformed"],
+        "retries": mock_translator.scheduler.retries + translator.retry_stats['calls']
+                   - translator.retry_stats['retried_batches'],
+        "failed_cues": len(failed),
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "peak_memory_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                                (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+    }
+
+
+def git_commit():
+    # The commit being measured, so results can be compared between versions
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the translation pipeline against a local mock provider.")
+    parser.add_argument("--cues", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="file sizes to benchmark (default 100 1000 10000)")
+    parser.add_argument("--batch-size", type=int, default=20, help="maximum subtitles per request")
+    parser.add_argument("--concurrency", type=int, default=4, help="batches translated at the same time")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock request latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of mock requests that raise")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="share of mock replies that are broken")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic files and the mock provider")
+    parser.add_argument("--output", help="write the JSON results to this file instead of standard output")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's progress messages")
+    args = parser.parse_args()
+
+    results = []
+    for cue_count in args.cues:
+        scenario = {"cues": cue_count, "batch_size": args.batch_size, "concurrency": args.concurrency,
+                    "latency": args.latency, "error_rate": args.error_rate,
+                    "malformed_rate": args.malformed_rate, "seed": args.seed, "target_lang": "fi",
+                    "quiet": not args.verbose}
+        # A fresh process for every size keeps the peak memory of one run from hiding the next
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_scenario, scenario).result()
+        results.append(result)
+        print(f"{cue_count:>7} cues: {result['cues_per_second']:>9.1f} cues/s, "
+              f"{result['api_calls_per_cue']:.3f} calls/cue, {result['retries']} retries, "
+              f"SQLite {result['sqlite_seconds']:.3f} s, peak {result['peak_memory_mb']} MB", file=sys.stderr)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "verbose")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import os
+import tempfile
+import time
+from db_func import DatabaseManager
+
+
+def create_database(db_path, cue_count):
+    # Create a database filled with synthetic subtitles
+    database_manager = DatabaseManager(db_path, False, None)
+    database_manager.create_table()
+    database_manager.save_many_to_db(
+        (index, "00:00:00,000 --> 00:00:01,000", f"Subtitle line {index}") for index in range(1, cue_count + 1))
+
+
+def run_batches(database_manager, cue_count, batch_size):
+    # Perform the database calls the translation loop makes for every batch
+    start_time = time.perf_counter()
+    batch_count = 0
+    for start_index in range(1, cue_count + 1, batch_size):
+        end_index = min(start_index + batch_size - 1, cue_count)
+        rows = database_manager.fetch_rows_to_translate(start_index, end_index, True)
+        database_manager.get_translation_from_index(start_index - 1)
+        database_manager.update_database([(index, text.upper()) for index, text in rows], True)
+        batch_count += 1
+    return (time.perf_counter() - start_time) / batch_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the per-batch database overhead of the translation loop.")
+    parser.add_argument("--cues", type=int, default=2000, help="number of subtitles in the test database")
+    parser.add_argument("--batch-size", type=int, default=5, help="number of subtitles per batch")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        # Use a separate database for each mode so the results do not affect each other
+        for reuse_connection in (False, True):
+            db_path = os.path.join(folder, f"benchmark_{reuse_connection}.db")
+            create_database(db_path, args.cues)
+
+            database_manager = DatabaseManager(db_path, True, None, reuse_connection=reuse_connection,
+                                               target_lang="fi")
+            per_batch = run_batches(database_manager, args.cues, args.batch_size)
+            database_manager.close()
+
+            mode = "shared connection" if reuse_connection else "connection per call"
+            print(f"{mode:>20}: {per_batch * 1e6:8.1f} us per batch")
+
+
+if __name__ == "__main__":
+    main()
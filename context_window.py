@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+
+class ContextWindow:
+    def __init__(self, size=3, char_budget=600, lookahead=0, max_entries=10000):
+        # size is the number of earlier translations given as context, char_budget caps their total length,
+        # and lookahead is the number of upcoming source subtitles shown after them
+        self.size = size
+        self.char_budget = char_budget
+        self.lookahead = lookahead
+        self.max_entries = max_entries
+
+        # Recent translations per language and recent source texts, both keyed by subtitle index
+        self.translations = {}
+        self.sources = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, target_lang, results):
+        # Remember finished (subtitle_index, text) translations; the oldest entries are dropped past max_entries
+        with self.lock:
+            translations = self.translations.setdefault(target_lang, OrderedDict())
+            for subtitle_index, text in results:
+                translations[subtitle_index] = text
+            while len(translations) > self.max_entries:
+                translations.popitem(last=False)
+
+    def add_sources(self, rows):
+        # Remember (subtitle_index, original_text) rows for the lookahead
+        if not self.lookahead:
+            return
+        with self.lock:
+            for subtitle_index, text in rows:
+                self.sources[subtitle_index] = text
+            while len(self.sources) > self.max_entries:
+                self.sources.popitem(last=False)
+
+    def previous(self, target_lang, subtitle_index, first_index=None):
+        # Return up to size translations just before subtitle_index, oldest first, within the character budget
+        # Gaps of untranslated subtitles are skipped, but the search stops a few windows back,
+        # and at first_index when the context has to stay within a scene
+        context = []
+        total_chars = 0
+        with self.lock:
+            translations = self.translations.get(target_lang, {})
+            lowest_index = max(subtitle_index - self.size * 4, first_index or 1)
+            for index in range(subtitle_index - 1, lowest_index - 1, -1):
+                text = translations.get(index)
+                if text is None:
+                    continue
+                if context and total_chars + len(text) > self.char_budget:
+                    break
+                context.append(text)
+                total_chars += len(text)
+                if len(context) >= self.size:
+                    break
+        return '\n'.join(reversed(context))
+
+    def upcoming(self, subtitle_index, last_index=None):
+        # Return up to lookahead source subtitles starting at subtitle_index, within the character budget,
+        # stopping after last_index when the context has to stay within a scene
+        context = []
+        total_chars = 0
+        with self.lock:
+            highest_index = subtitle_index + self.lookahead * 4 - 1
+            if last_index is not None:
+                highest_index = min(highest_index, last_index)
+            for index in range(subtitle_index, highest_index + 1):
+                if len(context) >= self.lookahead:
+                    break
+                text = self.sources.get(index)
+                if text is None:
+                    continue
+                if context and total_chars + len(text) > self.char_budget:
+                    break
+                context.append(text)
+                total_chars += len(text)
+        return '\n'.join(context)
@@ -1,5 +1,9 @@
 import sqlite3
 import os
+import threading
+import time
+from difflib import SequenceMatcher
+from srt_parser import content_hash
 
 
 class DatabaseConnection:
@@ -17,34 +21,179 @@ class DatabaseConnection:
         self.conn.close()
 
 
+class SharedConnection:
+    def __init__(self, db_path):
+        # Open one connection that is reused for the lifetime of the owner
+        # check_same_thread is disabled because access is serialized with a lock instead
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=256)
+
+        # Write-ahead logging lets readers and the writer work without blocking each other,
+        # and NORMAL synchronous mode is safe with WAL while skipping an fsync on every commit
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        # Keep up to 16 MB of pages in memory and temporary tables in RAM
+        self.conn.execute('PRAGMA cache_size=-16000')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+
+    def __enter__(self):
+        # Only one worker may use the connection at a time
+        self.lock.acquire()
+        return self.conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Do not leave a half-finished transaction behind for the next user of the connection
+        try:
+            if exc_type is not None and self.conn.in_transaction:
+                self.conn.rollback()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        # Close the shared connection
+        with self.lock:
+            self.conn.close()
+
+
 class DatabaseManager:
-    def __init__(self, db_path, overwrite_translations, file_path, index_range=None):
+    def __init__(self, db_path, overwrite_translations, file_path, index_range=None, reuse_connection=False,
+                 target_lang=None):
         # Initialize the database manager with configurations for database path,
         # whether to overwrite translations, the file path, and an optional index range
         self.overwrite_translations = overwrite_translations
         self.db_path = db_path
         self.file_path = file_path
         self.index_range = index_range
+        # Language used by the translation methods when they are not given one
+        self.target_lang = target_lang
+        # When reuse_connection is True, one connection is kept open until close() is called
+        self.shared_connection = SharedConnection(db_path) if reuse_connection else None
+
+    def connect(self):
+        # Return the shared connection if there is one, otherwise a new short-lived connection
+        if self.shared_connection is not None:
+            return self.shared_connection
+        return DatabaseConnection(self.db_path)
+
+    def close(self):
+        # Close the shared connection, if one was opened
+        if self.shared_connection is not None:
+            self.shared_connection.close()
+            self.shared_connection = None
 
     def create_table(self):
-        # Create a translations table if it doesn't exist
+        # Create the tables if they don't exist: translations holds the source subtitles once,
+        # and language_translations holds one translation per subtitle and target language
         try:
-            with DatabaseConnection(self.db_path) as conn:
+            with self.connect() as conn:
                 conn.execute('''
                     CREATE TABLE IF NOT EXISTS translations (
                         subtitle_index INTEGER PRIMARY KEY,
                         timestamp TEXT,
                         original_text TEXT,
-                        translated_text TEXT
+                        content_hash TEXT
+                    );
+                ''')
+                # Databases from before content hashes get the column; their hashes are computed when needed
+                columns = [row[1] for row in conn.execute('PRAGMA table_info(translations)')]
+                if 'content_hash' not in columns:
+                    conn.execute('ALTER TABLE translations ADD COLUMN content_hash TEXT')
+                # Fingerprint of the source file the subtitles were read from
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS source_state (
+                        key TEXT PRIMARY KEY,
+                        value TEXT
+                    );
+                ''')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS language_translations (
+                        subtitle_index INTEGER,
+                        target_lang TEXT,
+                        translated_text TEXT,
+                        PRIMARY KEY (subtitle_index, target_lang)
+                    );
+                ''')
+                # revision grows whenever the translations of a language change, and exported_revision
+                # records the revision last written to the SRT file, so unchanged files are not rewritten
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS export_state (
+                        target_lang TEXT PRIMARY KEY,
+                        revision INTEGER DEFAULT 0,
+                        exported_revision INTEGER,
+                        exported_path TEXT,
+                        exported_mtime REAL
+                    );
+                ''')
+                # Jobs submitted to the OpenAI Batch API and the subtitles each of their requests covers,
+                # so a job can be resumed and applied after the program has been restarted
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS batch_jobs (
+                        job_id TEXT PRIMARY KEY,
+                        status TEXT,
+                        created_at REAL
+                    );
+                ''')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS batch_job_requests (
+                        job_id TEXT,
+                        custom_id TEXT,
+                        target_lang TEXT,
+                        payload TEXT,
+                        PRIMARY KEY (job_id, custom_id)
+                    );
+                ''')
+                # Progress of every subtitle and language: pending, in_flight while a worker holds the lease,
+                # done or failed. Workers only claim subtitles that nobody holds, so an interrupted or
+                # parallel run neither loses finished batches nor sends the same subtitles twice
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS translation_state (
+                        subtitle_index INTEGER,
+                        target_lang TEXT,
+                        state TEXT DEFAULT 'pending',
+                        lease_owner TEXT,
+                        lease_expires REAL,
+                        attempts INTEGER DEFAULT 0,
+                        PRIMARY KEY (subtitle_index, target_lang)
+                    );
+                ''')
+                # The DeepL glossary made from the movie's glossary file for each language, reused between runs
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS deepl_glossaries (
+                        target_lang TEXT PRIMARY KEY,
+                        glossary_id TEXT,
+                        entries_hash TEXT
                     );
                 ''')
         except Exception as e:
             print(f"Error creating table: {e}")
 
+    def migrate_legacy_translations(self, target_lang):
+        # Databases from before per-language storage kept one translation in translations.translated_text.
+        # Move those translations to language_translations under the language they were translated into, once.
+        try:
+            with self.connect() as conn:
+                columns = [row[1] for row in conn.execute('PRAGMA table_info(translations)')]
+                if 'translated_text' not in columns:
+                    return
+                with conn:
+                    cursor = conn.execute('''
+                        INSERT OR IGNORE INTO language_translations (subtitle_index, target_lang, translated_text)
+                        SELECT subtitle_index, ?, translated_text
+                        FROM translations
+                        WHERE translated_text IS NOT NULL;
+                    ''', (target_lang,))
+                    conn.execute('UPDATE translations SET translated_text = NULL WHERE translated_text IS NOT NULL')
+                    self.bump_revision(conn, target_lang)
+                if cursor.rowcount > 0:
+                    print(f"Moved {cursor.rowcount} existing translations to language '{target_lang}'.")
+        except Exception as e:
+            print(f"Error migrating translations: {e}")
+
     def check_if_table_exists(self):
         # Check if the translations table exists
         try:
-            with DatabaseConnection(self.db_path) as conn:
+            with self.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='translations'")
                 return cursor.fetchone() is not None
@@ -54,7 +203,7 @@ class DatabaseManager:
     def check_if_data_exists(self):
         # Check if any data exists in the translations table
         try:
-            with DatabaseConnection(self.db_path) as conn:
+            with self.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT COUNT(*) FROM translations')
                 count = cursor.fetchone()[0]
@@ -65,7 +214,7 @@ class DatabaseManager:
     def save_to_db(self, subtitle_index, timestamp, original_text):
         # Save subtitle data to the database
         try:
-            with DatabaseConnection(self.db_path) as conn:
+            with self.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
                     INSERT INTO translations (subtitle_index, timestamp, original_text)
@@ -75,66 +224,165 @@ class DatabaseManager:
         except Exception as e:
             print(f"Error saving data to database: {e}")
 
-    def save_translations_to_srt(self, target_lang, movie_name, translations_folder):
-        # Luo uusi tiedostonimi elokuvan nimen ja kohdekielen perusteella
+    def save_many_to_db(self, rows):
+        # Save many subtitles to the database in a single transaction
+        # rows is an iterable of (subtitle_index, timestamp, original_text) tuples
+        try:
+            with self.connect() as conn:
+                with conn:
+                    cursor = conn.executemany('''
+                        INSERT INTO translations (subtitle_index, timestamp, original_text, content_hash)
+                        VALUES (?, ?, ?, ?);
+                    ''', ((str(subtitle_index), str(timestamp), str(original_text), content_hash(str(original_text)))
+                          for subtitle_index, timestamp, original_text in rows))
+                return cursor.rowcount
+        except Exception as e:
+            print(f"Error saving data to database: {e}")
+            return 0
+
+    def bump_revision(self, conn, target_lang=None):
+        # Mark the translations of a language, or of every language when target_lang is None, as changed
+        if target_lang is None:
+            conn.execute('UPDATE export_state SET revision = revision + 1')
+        else:
+            conn.execute('''
+                INSERT INTO export_state (target_lang, revision) VALUES (?, 1)
+                ON CONFLICT(target_lang) DO UPDATE SET revision = revision + 1;
+            ''', (target_lang,))
+
+    def is_export_current(self, conn, target_lang, translated_file_path):
+        # The file is current if nothing changed since it was written and nobody has touched it since
+        row = conn.execute('''
+            SELECT revision, exported_revision, exported_path, exported_mtime
+            FROM export_state WHERE target_lang = ?
+        ''', (target_lang,)).fetchone()
+        if row is None or row[1] is None or row[0] != row[1] or row[2] != translated_file_path:
+            return False
+        try:
+            return os.path.getmtime(translated_file_path) == row[3]
+        except OSError:
+            return False
+
+    def save_translations_to_srt(self, target_lang, movie_name, translations_folder, force=False):
+        # Create the new file name from the movie name and the target language
         new_file_name = f"{movie_name}.{target_lang}.srt"
         translated_file_path = os.path.join(translations_folder, new_file_name)
+        # Write to a temporary file first and rename it over the old one, so a crash never leaves half a file
+        temp_file_path = translated_file_path + ".tmp"
 
         try:
-            with DatabaseConnection(self.db_path) as conn, open(translated_file_path, 'w', encoding='utf-8') as file:
-                cursor = conn.cursor()
-                cursor.execute(
-                    'SELECT subtitle_index, timestamp, translated_text FROM translations ORDER BY subtitle_index')
-                rows = cursor.fetchall()
+            with self.connect() as conn:
+                # Skip the export when the file already has every translation
+                if not force and self.is_export_current(conn, target_lang, translated_file_path):
+                    print(f"Translated subtitles are up to date: {translated_file_path}")
+                    return
 
-                for subtitle_index, timestamp, translated_text in rows:
-                    file.write(f"{subtitle_index}\n{timestamp}\n{translated_text}\n\n")
+                revision_row = conn.execute('SELECT revision FROM export_state WHERE target_lang = ?',
+                                            (target_lang,)).fetchone()
+                revision = revision_row[0] if revision_row else 0
+
+                # Stream the rows from the cursor into a buffered file instead of loading them all
+                cursor = conn.execute('''
+                    SELECT t.subtitle_index, t.timestamp, l.translated_text
+                    FROM translations t
+                    LEFT JOIN language_translations l
+                        ON l.subtitle_index = t.subtitle_index AND l.target_lang = ?
+                    ORDER BY t.subtitle_index
+                ''', (target_lang,))
+                with open(temp_file_path, 'w', encoding='utf-8', buffering=1024 * 1024) as file:
+                    for subtitle_index, timestamp, translated_text in cursor:
+                        file.write(f"{subtitle_index}\n{timestamp}\n{translated_text}\n\n")
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_file_path, translated_file_path)
+
+                # Remember which revision the file holds
+                with conn:
+                    conn.execute('''
+                        INSERT INTO export_state (target_lang, revision, exported_revision, exported_path, exported_mtime)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(target_lang) DO UPDATE SET exported_revision = excluded.exported_revision,
+                            exported_path = excluded.exported_path, exported_mtime = excluded.exported_mtime;
+                    ''', (target_lang, revision, revision, translated_file_path,
+                          os.path.getmtime(translated_file_path)))
 
             print(f"Translated subtitles saved to file: {translated_file_path}")
         except Exception as e:
             print(f"Error saving translations to file: {e}")
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
 
-    def fetch_rows_to_translate(self, start_index, end_index, overwrite_translations):
-        # Fetch rows that need to be translated from the database
+    def fetch_rows_to_translate(self, start_index, end_index, overwrite_translations, target_lang=None):
+        # Fetch rows that need to be translated into the target language from the database
+        target_lang = target_lang or self.target_lang
         try:
-            with DatabaseConnection(self.db_path) as conn:
+            with self.connect() as conn:
                 cursor = conn.cursor()
                 if overwrite_translations:
                     cursor.execute('''
                         SELECT subtitle_index, original_text
                         FROM translations
                         WHERE subtitle_index >= ? AND subtitle_index <= ?
+                        ORDER BY subtitle_index
                     ''', (start_index, end_index))
                 else:
                     cursor.execute('''
-                        SELECT subtitle_index, original_text
-                        FROM translations
-                        WHERE subtitle_index >= ? AND subtitle_index <= ? AND translated_text IS NULL
-                    ''', (start_index, end_index))
+                        SELECT t.subtitle_index, t.original_text
+                        FROM translations t
+                        LEFT JOIN language_translations l
+                            ON l.subtitle_index = t.subtitle_index AND l.target_lang = ?
+                        WHERE t.subtitle_index >= ? AND t.subtitle_index <= ? AND l.translated_text IS NULL
+                        ORDER BY t.subtitle_index
+                    ''', (target_lang, start_index, end_index))
                 return cursor.fetchall()
         except Exception as e:
             print(f"Error fetching data: {e}")
 
-    def get_translation_from_index(self, index):
-        # Retrieve a translation from the database by its index
+    def get_translation_from_index(self, index, target_lang=None):
+        # Retrieve a translation into the target language from the database by its index
+        target_lang = target_lang or self.target_lang
         try:
-            with DatabaseConnection(self.db_path) as conn:
+            with self.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('''
-                    SELECT translated_text FROM translations
-                    WHERE subtitle_index = ? AND translated_text IS NOT NULL
-                ''', (index,))
+                    SELECT translated_text FROM language_translations
+                    WHERE subtitle_index = ? AND target_lang = ? AND translated_text IS NOT NULL
+                ''', (index, target_lang))
                 result = cursor.fetchone()
                 return result[0] if result else ""
         except Exception as e:
             print(f"Error retrieving data: {e}")
 
-    def get_last_translated_index(self):
-        # Get the index of the last translated subtitle
+    def get_translations_before(self, index, limit, target_lang=None):
+        # Retrieve up to limit (subtitle_index, translated_text) pairs just before index, oldest first
+        target_lang = target_lang or self.target_lang
         try:
-            with DatabaseConnection(self.db_path) as conn:
+            with self.connect() as conn:
                 cursor = conn.cursor()
-                cursor.execute('SELECT MIN(subtitle_index) FROM translations WHERE translated_text IS NULL')
+                cursor.execute('''
+                    SELECT subtitle_index, translated_text FROM language_translations
+                    WHERE target_lang = ? AND subtitle_index < ? AND translated_text IS NOT NULL
+                    ORDER BY subtitle_index DESC
+                    LIMIT ?
+                ''', (target_lang, index, limit))
+                return list(reversed(cursor.fetchall()))
+        except Exception as e:
+            print(f"Error retrieving data: {e}")
+            return []
+
+    def get_last_translated_index(self, target_lang=None):
+        # Get the index of the first subtitle that has no translation into the target language
+        target_lang = target_lang or self.target_lang
+        try:
+            with self.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT MIN(t.subtitle_index)
+                    FROM translations t
+                    LEFT JOIN language_translations l
+                        ON l.subtitle_index = t.subtitle_index AND l.target_lang = ?
+                    WHERE l.translated_text IS NULL
+                ''', (target_lang,))
                 result = cursor.fetchone()
                 return result[0] if result[0] is not None else 1
         except Exception as e:
@@ -143,7 +391,7 @@ class DatabaseManager:
     def get_max_subtitle_index(self):
         # Retrieve the highest subtitle index in the database
         try:
-            with DatabaseConnection(self.db_path) as conn:
+            with self.connect() as conn:
                 cursor = conn.cursor()
                 cursor.execute('SELECT MAX(subtitle_index) FROM translations')
                 result = cursor.fetchone()
@@ -152,27 +400,383 @@ class DatabaseManager:
             print(f"Error retrieving max subtitle index: {e}")
             return None
 
-    def update_database(self, translations, update_translations):
+    def get_timestamps(self):
+        # Retrieve the (subtitle_index, timestamp) pairs of every subtitle, in index order
+        try:
+            with self.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT subtitle_index, timestamp FROM translations ORDER BY subtitle_index')
+                return cursor.fetchall()
+        except Exception as e:
+            print(f"Error retrieving timestamps: {e}")
+            return []
+
+    def get_qa_rows(self, target_lang=None):
+        # Retrieve the subtitles that have a translation into the target language, in index order,
+        # as four parallel lists: indices, timestamps, original texts and translations
+        target_lang = target_lang or self.target_lang
+        try:
+            with self.connect() as conn:
+                rows = conn.execute('''
+                    SELECT t.subtitle_index, t.timestamp, t.original_text, l.translated_text
+                    FROM translations t
+                    JOIN language_translations l ON l.subtitle_index = t.subtitle_index AND l.target_lang = ?
+                    WHERE l.translated_text IS NOT NULL
+                    ORDER BY t.subtitle_index
+                ''', (target_lang,)).fetchall()
+            if not rows:
+                return [], [], [], []
+            return tuple(list(column) for column in zip(*rows))
+        except Exception as e:
+            print(f"Error retrieving translations for the QA pass: {e}")
+            return [], [], [], []
+
+    def keep_translations(self, indices, target_lang=None):
+        # Mark subtitles whose new translation failed as done again when they still have their earlier translation,
+        # so a failed second attempt is not reported or retried as a missing translation
+        target_lang = target_lang or self.target_lang
+        try:
+            with self.connect() as conn:
+                with conn:
+                    conn.executemany('''
+                        UPDATE translation_state SET state = 'done', lease_owner = NULL, lease_expires = NULL
+                        WHERE subtitle_index = ? AND target_lang = ? AND state = 'failed'
+                        AND EXISTS (SELECT 1 FROM language_translations l
+                                    WHERE l.subtitle_index = translation_state.subtitle_index
+                                    AND l.target_lang = translation_state.target_lang
+                                    AND l.translated_text IS NOT NULL)
+                    ''', [(subtitle_index, target_lang) for subtitle_index in indices])
+        except Exception as e:
+            print(f"Error updating subtitle states: {e}")
+
+    def get_translated_count(self, target_lang=None):
+        # Count the subtitles that have a translation into the target language
+        target_lang = target_lang or self.target_lang
+        try:
+            with self.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT COUNT(*) FROM language_translations
+                    WHERE target_lang = ? AND translated_text IS NOT NULL
+                ''', (target_lang,))
+                return cursor.fetchone()[0]
+        except Exception as e:
+            print(f"Error counting translations: {e}")
+            return 0
+
+    def update_database(self, translations, update_translations, target_lang=None):
         # Update the database with new translations. If update_translations is True, existing translations will be overwritten.
-        # If False, only empty (NULL) translation fields will be updated, leaving any existing translations untouched.
-        try:
-            with DatabaseConnection(self.db_path) as conn:
-                cursor = conn.cursor()
-                for subtitle_index, translated_text in translations:
-                    if update_translations:
-                        # Overwrite the translated_text field for the given subtitle_index
-                        cursor.execute('''
-                            UPDATE translations
-                            SET translated_text = ?
-                            WHERE subtitle_index = ?;
-                        ''', (translated_text, subtitle_index))
-                    else:
-                        # Only update the translated_text field where it is currently NULL, to avoid overwriting existing translations
-                        cursor.execute('''
-                            UPDATE translations
-                            SET translated_text = ?
-                            WHERE subtitle_index = ? AND translated_text IS NULL;
-                        ''', (translated_text, subtitle_index))
+        # If False, only missing translations will be added, leaving any existing translations untouched.
+        target_lang = target_lang or self.target_lang
+        try:
+            with self.connect() as conn:
+                self.write_translations(conn, translations, update_translations, target_lang)
                 conn.commit()
         except Exception as e:
             print(f"Error updating database: {e}")
+
+    def write_translations(self, conn, translations, update_translations, target_lang):
+        # Write (subtitle_index, translated_text) pairs within the caller's transaction
+        cursor = conn.cursor()
+        if update_translations:
+            # Overwrite the translation for the given subtitle_index and language
+            cursor.executemany('''
+                INSERT OR REPLACE INTO language_translations (subtitle_index, target_lang, translated_text)
+                VALUES (?, ?, ?);
+            ''', [(subtitle_index, target_lang, translated_text)
+                  for subtitle_index, translated_text in translations])
+        else:
+            # Only add translations that do not exist yet, to avoid overwriting existing translations
+            cursor.executemany('''
+                INSERT OR IGNORE INTO language_translations (subtitle_index, target_lang, translated_text)
+                VALUES (?, ?, ?);
+            ''', [(subtitle_index, target_lang, translated_text)
+                  for subtitle_index, translated_text in translations])
+        # The exported SRT file is out of date once a translation changes
+        if cursor.rowcount > 0:
+            self.bump_revision(conn, target_lang)
+
+    def claim_rows(self, indices, owner, lease_seconds, include_done=False, target_lang=None):
+        # Lease subtitles of a language to owner and return the set of indices it now holds.
+        # Subtitles held by another worker whose lease has not run out are skipped,
+        # and so are finished subtitles unless include_done is True.
+        target_lang = target_lang or self.target_lang
+        indices = list(indices)
+        now = time.time()
+        claimable = "('pending', 'failed', 'done')" if include_done else "('pending', 'failed')"
+        try:
+            with self.connect() as conn:
+                with conn:
+                    conn.executemany('''
+                        INSERT OR IGNORE INTO translation_state (subtitle_index, target_lang, state)
+                        VALUES (?, ?, 'pending')
+                    ''', [(subtitle_index, target_lang) for subtitle_index in indices])
+                    # The lease is taken inside the write transaction, so two workers cannot both win it
+                    conn.executemany(f'''
+                        UPDATE translation_state SET state = 'in_flight', lease_owner = ?, lease_expires = ?
+                        WHERE subtitle_index = ? AND target_lang = ?
+                        AND (state IN {claimable} OR (state = 'in_flight' AND (lease_expires < ? OR lease_owner = ?)))
+                    ''', [(owner, now + lease_seconds, subtitle_index, target_lang, now, owner)
+                          for subtitle_index in indices])
+                    placeholders = ','.join('?' * len(indices))
+                    cursor = conn.execute(f'''
+                        SELECT subtitle_index FROM translation_state
+                        WHERE target_lang = ? AND state = 'in_flight' AND lease_owner = ?
+                        AND subtitle_index IN ({placeholders})
+                    ''', [target_lang, owner] + indices)
+                    return {row[0] for row in cursor.fetchall()}
+        except Exception as e:
+            print(f"Error claiming subtitles: {e}")
+            return set()
+
+    def finish_batch(self, translations, failed_indices, update_translations, target_lang=None):
+        # Store the translations of a finished batch and mark its subtitles done or failed in one transaction,
+        # so a batch is either recorded completely or not at all
+        target_lang = target_lang or self.target_lang
+        try:
+            with self.connect() as conn:
+                with conn:
+                    self.write_translations(conn, translations, update_translations, target_lang)
+                    conn.executemany('''
+                        INSERT INTO translation_state (subtitle_index, target_lang, state) VALUES (?, ?, 'done')
+                        ON CONFLICT (subtitle_index, target_lang) DO UPDATE
+                        SET state = 'done', lease_owner = NULL, lease_expires = NULL
+                    ''', [(subtitle_index, target_lang) for subtitle_index, _ in translations])
+                    conn.executemany('''
+                        INSERT INTO translation_state (subtitle_index, target_lang, state, attempts)
+                        VALUES (?, ?, 'failed', 1)
+                        ON CONFLICT (subtitle_index, target_lang) DO UPDATE
+                        SET state = 'failed', attempts = attempts + 1, lease_owner = NULL, lease_expires = NULL
+                    ''', [(subtitle_index, target_lang) for subtitle_index in failed_indices])
+        except Exception as e:
+            print(f"Error updating database: {e}")
+
+    def release_leases(self, owner):
+        # Hand back the subtitles owner still holds, so the next run can claim them at once
+        try:
+            with self.connect() as conn:
+                with conn:
+                    conn.execute('''
+                        UPDATE translation_state SET state = 'pending', lease_owner = NULL, lease_expires = NULL
+                        WHERE state = 'in_flight' AND lease_owner = ?
+                    ''', (owner,))
+        except Exception as e:
+            print(f"Error releasing subtitles: {e}")
+
+    def get_failed_translations(self, target_langs):
+        # Return the (target_lang, subtitle_index) pairs whose last attempt failed
+        try:
+            with self.connect() as conn:
+                cursor = conn.cursor()
+                placeholders = ','.join('?' * len(target_langs))
+                cursor.execute(f'''
+                    SELECT target_lang, subtitle_index FROM translation_state
+                    WHERE state = 'failed' AND target_lang IN ({placeholders})
+                    ORDER BY subtitle_index, target_lang
+                ''', list(target_langs))
+                return cursor.fetchall()
+        except Exception as e:
+            print(f"Error retrieving failed translations: {e}")
+            return []
+
+    def save_batch_job(self, job_id, requests):
+        # Store a submitted Batch API job with its (custom_id, target_lang, payload) requests
+        try:
+            with self.connect() as conn:
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO batch_jobs (job_id, status, created_at) VALUES (?, ?, ?)",
+                                 (job_id, 'submitted', time.time()))
+                    conn.executemany('''
+                        INSERT OR REPLACE INTO batch_job_requests (job_id, custom_id, target_lang, payload)
+                        VALUES (?, ?, ?, ?)
+                    ''', [(job_id, custom_id, target_lang, payload) for custom_id, target_lang, payload in requests])
+        except Exception as e:
+            print(f"Error saving batch job: {e}")
+
+    def set_batch_job_status(self, job_id, status):
+        # Record the last known status of a Batch API job
+        try:
+            with self.connect() as conn:
+                with conn:
+                    conn.execute("UPDATE batch_jobs SET status = ? WHERE job_id = ?", (status, job_id))
+        except Exception as e:
+            print(f"Error updating batch job: {e}")
+
+    def get_open_batch_job(self):
+        # Return the id of the newest job whose results have not been applied yet, or None
+        try:
+            with self.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    SELECT job_id FROM batch_jobs WHERE status NOT IN ('applied', 'discarded')
+                    ORDER BY created_at DESC LIMIT 1
+                ''')
+                result = cursor.fetchone()
+                return result[0] if result else None
+        except Exception as e:
+            print(f"Error retrieving batch job: {e}")
+            return None
+
+    def get_batch_job_requests(self, job_id):
+        # Return the (custom_id, target_lang, payload) requests of a Batch API job
+        try:
+            with self.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT custom_id, target_lang, payload FROM batch_job_requests WHERE job_id = ?",
+                               (job_id,))
+                return cursor.fetchall()
+        except Exception as e:
+            print(f"Error retrieving batch job requests: {e}")
+            return []
+
+    def get_original_texts(self, indices):
+        # Return (subtitle_index, original_text) rows for the given indices, in index order
+        indices = list(indices)
+        try:
+            with self.connect() as conn:
+                cursor = conn.cursor()
+                placeholders = ','.join('?' * len(indices))
+                cursor.execute(f'''
+                    SELECT subtitle_index, original_text FROM translations
+                    WHERE subtitle_index IN ({placeholders})
+                    ORDER BY subtitle_index
+                ''', indices)
+                return cursor.fetchall()
+        except Exception as e:
+            print(f"Error retrieving data: {e}")
+            return []
+
+    def get_glossary(self, target_lang=None):
+        # Return the (glossary_id, entries_hash) stored for a language, or None
+        target_lang = target_lang or self.target_lang
+        try:
+            with self.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT glossary_id, entries_hash FROM deepl_glossaries WHERE target_lang = ?",
+                               (target_lang,))
+                return cursor.fetchone()
+        except Exception as e:
+            print(f"Error retrieving glossary: {e}")
+            return None
+
+    def save_glossary(self, glossary_id, entries_hash, target_lang=None):
+        # Remember the DeepL glossary used for a language
+        target_lang = target_lang or self.target_lang
+        try:
+            with self.connect() as conn:
+                with conn:
+                    conn.execute('''
+                        INSERT OR REPLACE INTO deepl_glossaries (target_lang, glossary_id, entries_hash)
+                        VALUES (?, ?, ?)
+                    ''', (target_lang, glossary_id, entries_hash))
+        except Exception as e:
+            print(f"Error saving glossary: {e}")
+
+    def get_source_hash(self):
+        # Return the fingerprint of the source file stored with the subtitles, or None
+        try:
+            with self.connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT value FROM source_state WHERE key = 'file_hash'")
+                result = cursor.fetchone()
+                return result[0] if result else None
+        except Exception as e:
+            print(f"Error retrieving source state: {e}")
+            return None
+
+    def save_source_hash(self, file_hash):
+        # Remember the fingerprint of the source file the subtitles were read from
+        try:
+            with self.connect() as conn:
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO source_state (key, value) VALUES ('file_hash', ?)",
+                                 (file_hash,))
+        except Exception as e:
+            print(f"Error saving source state: {e}")
+
+    def resync_source(self, rows):
+        # Bring the stored subtitles in line with a changed source file, given its
+        # (subtitle_index, timestamp, original_text) rows, and return counts of what changed.
+        # Cues are matched by their content hash in file order, so cues that moved or were retimed keep their
+        # translations under their new index and timestamp. Edited and new cues lose theirs and are
+        # translated again, and removed cues are deleted.
+        rows = [(int(subtitle_index), str(timestamp), str(original_text), content_hash(str(original_text)))
+                for subtitle_index, timestamp, original_text in rows]
+        stats = {'unchanged': 0, 'retimed': 0, 'edited': 0, 'added': 0, 'removed': 0}
+        try:
+            with self.connect() as conn:
+                stored = conn.execute('''
+                    SELECT subtitle_index, timestamp, original_text, content_hash FROM translations
+                    ORDER BY subtitle_index
+                ''').fetchall()
+                stored_hashes = [row[3] or content_hash(row[2]) for row in stored]
+
+                # autojunk is off, otherwise frequent lines such as "Yeah." would never be matched
+                matcher = SequenceMatcher(None, stored_hashes, [row[3] for row in rows], autojunk=False)
+                index_map = []
+                for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                    if tag == 'equal':
+                        for old_row, new_row in zip(stored[i1:i2], rows[j1:j2]):
+                            index_map.append((old_row[0], new_row[0]))
+                            if old_row[0] == new_row[0] and old_row[1] == new_row[1] and old_row[2] == new_row[2]:
+                                stats['unchanged'] += 1
+                            else:
+                                stats['retimed'] += 1
+                    else:
+                        # Cues replaced at the same position count as edits, the rest as added or removed
+                        edited = min(i2 - i1, j2 - j1)
+                        stats['edited'] += edited
+                        stats['removed'] += i2 - i1 - edited
+                        stats['added'] += j2 - j1 - edited
+
+                if stats['unchanged'] == len(stored) == len(rows):
+                    return stats
+
+                with conn:
+                    # Move the translations and finished states of matched cues to their new indices
+                    for table in ('index_map', 'kept_translations', 'kept_states'):
+                        conn.execute(f'DROP TABLE IF EXISTS temp.{table}')
+                    conn.execute('CREATE TEMP TABLE index_map (old_index INTEGER PRIMARY KEY, new_index INTEGER)')
+                    conn.executemany('INSERT INTO index_map (old_index, new_index) VALUES (?, ?)', index_map)
+                    conn.execute('''
+                        CREATE TEMP TABLE kept_translations AS
+                        SELECT m.new_index AS subtitle_index, l.target_lang, l.translated_text
+                        FROM language_translations l JOIN index_map m ON l.subtitle_index = m.old_index
+                    ''')
+                    conn.execute('''
+                        CREATE TEMP TABLE kept_states AS
+                        SELECT m.new_index AS subtitle_index, s.target_lang, s.attempts
+                        FROM translation_state s JOIN index_map m ON s.subtitle_index = m.old_index
+                        WHERE s.state = 'done'
+                    ''')
+                    languages = [row[0] for row in conn.execute(
+                        'SELECT DISTINCT target_lang FROM language_translations UNION SELECT target_lang FROM export_state')]
+
+                    conn.execute('DELETE FROM translations')
+                    conn.executemany('''
+                        INSERT INTO translations (subtitle_index, timestamp, original_text, content_hash)
+                        VALUES (?, ?, ?, ?)
+                    ''', rows)
+                    conn.execute('DELETE FROM language_translations')
+                    conn.execute('''
+                        INSERT INTO language_translations (subtitle_index, target_lang, translated_text)
+                        SELECT subtitle_index, target_lang, translated_text FROM kept_translations
+                    ''')
+                    conn.execute('DELETE FROM translation_state')
+                    conn.execute('''
+                        INSERT INTO translation_state (subtitle_index, target_lang, state, attempts)
+                        SELECT subtitle_index, target_lang, 'done', attempts FROM kept_states
+                    ''')
+                    conn.execute('DROP TABLE index_map')
+                    conn.execute('DROP TABLE kept_translations')
+                    conn.execute('DROP TABLE kept_states')
+
+                    # Batch jobs still running refer to the old indices, so their results are not applied
+                    conn.execute("UPDATE batch_jobs SET status = 'discarded' WHERE status NOT IN ('applied', 'discarded')")
+                    # Every exported file has to be written again with the new timings
+                    for target_lang in languages:
+                        self.bump_revision(conn, target_lang)
+            return stats
+        except Exception as e:
+            print(f"Error updating subtitles from the source file: {e}")
+            return None
@@ -1,17 +1,154 @@
 import deepl
 from dotenv import load_dotenv
+import hashlib
 import os
+import threading
+from rate_limiter import get_scheduler, parse_retry_after, FatalProviderError
 
 load_dotenv()
 
-auth_key = os.getenv("DEEPL_API_KEY")
-translator = deepl.Translator(auth_key)
+# One translator, and so one HTTP session, is shared by every worker in the process.
+# It is created on first use, so importing this module does not need an API key.
+translator = None
+translator_lock = threading.Lock()
+
+# DeepL accepts up to 50 texts and 128 KiB in one request; the character budget leaves room for the
+# JSON encoding and for characters that take several bytes
+MAX_LIST_TEXTS = 50
+MAX_LIST_CHARS = 30000
+
+# Glossaries need the source language, which is otherwise detected by DeepL
+GLOSSARY_SOURCE_LANG = os.getenv('DEEPL_SOURCE_LANG', 'EN')
+
+# Requests per minute allowed for the account, shared by every worker in the process (0 means no limit)
+scheduler = get_scheduler("DeepL", requests_per_minute=int(os.getenv('DEEPL_REQUESTS_PER_MINUTE', 0)))
+
+
+def get_translator():
+    # Return the shared translator, creating it on first use
+    global translator
+    with translator_lock:
+        if translator is None:
+            # Retries are handled by the shared scheduler, so the SDK does not retry on its own; otherwise its
+            # backoff would hide throttling from the other workers and send requests the limits never count
+            deepl.http_client.max_network_retries = 0
+            translator = deepl.Translator(os.getenv("DEEPL_API_KEY"))
+        return translator
+
+
+def classify_deepl_error(error):
+    # Throttling, connection problems and server errors are worth retrying;
+    # an exhausted quota, a bad key or a bad request will not get better by waiting
+    if isinstance(error, deepl.QuotaExceededException) or isinstance(error, deepl.AuthorizationException):
+        return False, None
+    if isinstance(error, deepl.TooManyRequestsException):
+        return True, parse_retry_after(getattr(error, 'headers', None))
+    if isinstance(error, deepl.ConnectionException):
+        return True, None
+    status_code = getattr(error, 'http_status_code', None)
+    if status_code is not None and status_code >= 500:
+        return True, None
+    return False, None
 
 
 def translate_deepl(original_text, target_lang):
     try:
-        result = translator.translate_text(original_text, target_lang=target_lang, preserve_formatting=True)
+        result = scheduler.call(
+            lambda: get_translator().translate_text(original_text, target_lang=target_lang, preserve_formatting=True),
+            classify_deepl_error
+        )
         return result.text  # Assuming you want to return the translated text
+    except FatalProviderError:
+        # A bad key, an exhausted quota or a rejected request fails the batch without more attempts
+        raise
     except Exception as e:
         print(f"Error during translation with DeepL: {e}")
         return None
+
+
+def translate(original_text, target_lang, **options):
+    # Provider entry point used by the Translator; DeepL needs no context
+    return translate_deepl(original_text, target_lang)
+
+
+def translate_list(texts, target_lang, glossary_id=None):
+    # Provider entry point for translating a list of subtitles
+    return translate_deepl_list(texts, target_lang, glossary_id)
+
+
+def translate_deepl_list(texts, target_lang, glossary_id=None):
+    # Translate a list of subtitles in as few requests as the limits allow and return one translation
+    # per text, in the same order, or None if a request failed
+    options = {"target_lang": target_lang, "preserve_formatting": True}
+    if glossary_id:
+        options["source_lang"] = GLOSSARY_SOURCE_LANG
+        options["glossary"] = glossary_id
+
+    translated_texts = []
+    start = 0
+    while start < len(texts):
+        # Take as many texts as fit into one request
+        end = start
+        chars = 0
+        while end < len(texts) and end - start < MAX_LIST_TEXTS and (
+                end == start or chars + len(texts[end]) <= MAX_LIST_CHARS):
+            chars += len(texts[end])
+            end += 1
+        chunk = texts[start:end]
+        try:
+            results = scheduler.call(lambda: get_translator().translate_text(chunk, **options), classify_deepl_error)
+        except FatalProviderError:
+            raise
+        except Exception as e:
+            print(f"Error during translation with DeepL: {e}")
+            return None
+        translated_texts.extend(result.text for result in results)
+        start = end
+    return translated_texts
+
+
+def read_glossary_entries(glossary_path):
+    # Read a glossary file with one "source<TAB>translation" pair per line; lines starting with # are comments
+    entries = {}
+    with open(glossary_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#') or '\t' not in line:
+                continue
+            source, target = line.split('\t', 1)
+            if source.strip() and target.strip():
+                entries[source.strip()] = target.strip()
+    return entries
+
+
+def glossary_hash(target_lang, entries):
+    # Fingerprint of the glossary contents, used to notice when the file has changed
+    text = GLOSSARY_SOURCE_LANG + '\n' + target_lang + '\n' + '\n'.join(
+        f"{source}\t{target}" for source, target in sorted(entries.items()))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def ensure_glossary(name, target_lang, entries, glossary_id=None):
+    # Return the id of a DeepL glossary with the entries, reusing glossary_id while it still exists
+    if glossary_id:
+        try:
+            get_translator().get_glossary(glossary_id)
+            return glossary_id
+        except deepl.DeepLException:
+            pass
+    try:
+        # Glossaries are defined for a language pair without regional variants, e.g. EN and PT rather than PT-BR
+        glossary = get_translator().create_glossary(name, source_lang=GLOSSARY_SOURCE_LANG,
+                                              target_lang=target_lang.split('-')[0], entries=entries)
+        return glossary.glossary_id
+    except Exception as e:
+        print(f"Error creating DeepL glossary: {e}")
+        return None
+
+
+def delete_glossary(glossary_id):
+    # Remove a glossary that has been replaced, ignoring glossaries that are already gone
+    try:
+        get_translator().delete_glossary(glossary_id)
+    except Exception as e:
+        print(f"Error deleting DeepL glossary: {e}")
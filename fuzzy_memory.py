@@ -0,0 +1,412 @@
+import argparse
+import mmap
+import os
+import random
+import re
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from srt_parser import normalize_text
+
+# Near-duplicate lookup over the translation cache: every cached source text gets a MinHash signature of its
+# character trigrams, cut into bands. Texts that share a band are candidates, and candidates are compared
+# exactly before they are used. The band keys of all entries are kept sorted in a file next to the cache,
+# which is memory-mapped and searched with bisect, so a lookup costs a few binary searches at any corpus size.
+
+NUM_PERM = 32
+BANDS = 8
+ROWS_PER_BAND = NUM_PERM // BANDS
+# A band key shared by more entries than this is too common to tell anything apart, such as in "Yes."
+MAX_BUCKET = 64
+
+# Mersenne prime for the permutations, and fixed coefficients so every process computes the same signatures
+PRIME = (1 << 61) - 1
+_random = random.Random(20240601)
+PERMUTATIONS = [(_random.randrange(1, PRIME), _random.randrange(0, PRIME)) for _ in range(NUM_PERM)]
+
+# magic, 1 if the arrays are little-endian, entries, highest cache rowid in the file, build time
+HEADER = struct.Struct('<8sBxxxIqd')
+MAGIC = b'SRTFZIX1'
+
+# Entries of the fuzzy_imports table are stored in the index with this bit set on their id, which keeps them
+# apart from the rowids of the translation cache
+IMPORTED_FLAG = 1 << 31
+
+TRAILING_PUNCTUATION = re.compile(r'[\s.!?…,;:]*$')
+
+
+def word_key(text):
+    # The words of a text in lower case, without punctuation or line breaks
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+def shingles(text, size=3):
+    # Hashes of the character trigrams of the text's words; texts shorter than a trigram are one shingle
+    key = word_key(text)
+    if not key:
+        return set()
+    if len(key) <= size:
+        return {zlib.crc32(key.encode('utf-8'))}
+    return {zlib.crc32(key[i:i + size].encode('utf-8')) for i in range(len(key) - size + 1)}
+
+
+def band_keys(text):
+    # The BANDS 32-bit LSH keys of a text, or an empty list for a text without words, such as "♪"
+    hashes = shingles(text)
+    if not hashes:
+        return []
+    signature = [min([(a * value + b) % PRIME for value in hashes]) for a, b in PERMUTATIONS]
+    return [zlib.crc32(struct.pack('<B4Q', band, *signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]))
+            for band in range(BANDS)]
+
+
+def pack_keys(keys):
+    # Band keys as the blob stored in the cache
+    return array('I', keys).tobytes() if keys else None
+
+
+def unpack_keys(blob):
+    # Band keys from a blob stored in the cache
+    keys = array('I')
+    if blob:
+        keys.frombytes(blob)
+    return list(keys)
+
+
+def similarity(text, other_text):
+    # Share of trigrams the two texts have in common (Jaccard similarity)
+    first, second = shingles(text), shingles(other_text)
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def adapt_punctuation(text, match_source, translation):
+    # Give the translation of match_source the closing punctuation of text, e.g. "..." instead of "."
+    old_ending = TRAILING_PUNCTUATION.search(match_source).group().strip()
+    new_ending = TRAILING_PUNCTUATION.search(text).group().strip()
+    if old_ending == new_ending:
+        return translation
+    return translation[:TRAILING_PUNCTUATION.search(translation).start()] + new_ending
+
+
+def write_index(index_path, entries, max_rowid):
+    # Write the (rowid, band_keys) entries as an index file of sorted band keys and the matching rowids
+    pairs = sorted((key, rowid) for rowid, keys in entries for key in keys)
+    keys = array('I', (key for key, _ in pairs))
+    rowids = array('I', (rowid for _, rowid in pairs))
+    # Every writer gets its own temporary file, as several processes may rebuild the index at the same time
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(index_path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, 1 if sys.byteorder == 'little' else 0, len(pairs), max_rowid, time.time()))
+            keys.tofile(file)
+            rowids.tofile(file)
+        # Replace the old file in one step, so other processes see either the old or the new index
+        os.replace(temp_path, index_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+class FuzzyIndex:
+    def __init__(self, index_path):
+        # Memory-map an index file written by write_index; raises ValueError if it cannot be used here
+        self.file = open(index_path, 'rb')
+        try:
+            header = self.file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError("index file is truncated")
+            magic, little_endian, self.count, self.max_rowid, self.built_at = HEADER.unpack(header)
+            if magic != MAGIC or bool(little_endian) != (sys.byteorder == 'little'):
+                raise ValueError("index file was written by another version or platform")
+            if self.count == 0:
+                self.map = None
+                self.keys = self.rowids = []
+                return
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self.map) < HEADER.size + self.count * 8:
+                raise ValueError("index file is truncated")
+            view = memoryview(self.map)
+            self.keys = view[HEADER.size:HEADER.size + self.count * 4].cast('I')
+            self.rowids = view[HEADER.size + self.count * 4:HEADER.size + self.count * 8].cast('I')
+        except Exception:
+            self.file.close()
+            raise
+
+    def candidates(self, keys):
+        # Yield the rowid of every entry that shares a band key with keys
+        for key in keys:
+            position = bisect_left(self.keys, key)
+            end = position
+            while end < self.count and self.keys[end] == key and end - position < MAX_BUCKET:
+                end += 1
+            for i in range(position, end):
+                yield self.rowids[i]
+
+    def close(self):
+        # Release the memory map and the file
+        if self.map is not None:
+            self.keys.release()
+            self.rowids.release()
+            self.map.close()
+        self.file.close()
+
+
+class FuzzyMemory:
+    def __init__(self, cache, threshold=0.7, max_matches=3, rebuild_ratio=0.1):
+        # Near-duplicate lookups in a TranslationCache. threshold is the smallest trigram similarity that
+        # counts as a match. The index file is rebuilt when the entries added since it was written exceed
+        # rebuild_ratio of it; until then the newer entries are looked up from memory.
+        self.cache = cache
+        self.threshold = threshold
+        self.max_matches = max_matches
+        self.rebuild_ratio = rebuild_ratio
+        self.index_path = os.path.splitext(cache.cache_path)[0] + '.lsh'
+        self.index = None
+        self.loaded = False
+
+        # Band keys of the entries newer than the index file: key -> rowids
+        self.recent = {}
+        self.recent_rowid = 0
+
+        # Statistics for the current run
+        self.reused = 0
+        self.examples = 0
+
+    def load(self):
+        # Open the index file, rebuilding it first if it is missing or too far behind the cache
+        self.loaded = True
+        try:
+            with self.cache.connection as conn:
+                count, max_rowid = conn.execute(
+                    'SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM translation_cache').fetchone()
+            index = None
+            if os.path.exists(self.index_path):
+                try:
+                    index = FuzzyIndex(self.index_path)
+                except (OSError, ValueError) as e:
+                    print(f"Rebuilding the fuzzy translation memory index: {e}")
+            if index is None or max_rowid - index.max_rowid > max(1000, count * self.rebuild_ratio):
+                if index is not None:
+                    index.close()
+                self.build()
+                index = FuzzyIndex(self.index_path)
+            self.index = index
+            self.recent_rowid = index.max_rowid
+        except Exception as e:
+            print(f"Error loading the fuzzy translation memory: {e}")
+
+    def create_import_table(self, conn):
+        # Create the table of imported translations if it doesn't exist. They can only serve as examples, so they
+        # are kept apart from the translation cache, where they would push out reusable entries when the least
+        # recently used ones are evicted. Imports from before the table existed are moved into it.
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS fuzzy_imports (
+                    id INTEGER PRIMARY KEY,
+                    source_text TEXT,
+                    target_lang TEXT,
+                    translated_text TEXT,
+                    lsh_keys BLOB,
+                    UNIQUE (source_text, target_lang, translated_text)
+                );
+            ''')
+            if conn.execute("SELECT 1 FROM translation_cache WHERE service = 'imported' LIMIT 1").fetchone():
+                conn.execute('''
+                    INSERT OR IGNORE INTO fuzzy_imports (source_text, target_lang, translated_text, lsh_keys)
+                    SELECT source_text, target_lang, translated_text, lsh_keys FROM translation_cache
+                    WHERE service = 'imported'
+                ''')
+                conn.execute("DELETE FROM translation_cache WHERE service = 'imported'")
+
+    def add_imports(self, entries, target_lang):
+        # Store imported (source_text, translated_text) pairs; they are indexed when the index is next built
+        with self.cache.connection as conn:
+            self.create_import_table(conn)
+            with conn:
+                conn.executemany('''
+                    INSERT OR IGNORE INTO fuzzy_imports (source_text, target_lang, translated_text, lsh_keys)
+                    VALUES (?, ?, ?, ?)
+                ''', [(normalize_text(source_text), target_lang, translated_text, pack_keys(band_keys(source_text)))
+                      for source_text, translated_text in entries])
+
+    def build(self):
+        # Compute the band keys of cache entries that have none yet and write the index file
+        # of the cache entries and the imported translations
+        with self.cache.connection as conn:
+            self.create_import_table(conn)
+            missing = conn.execute('SELECT rowid, source_text FROM translation_cache '
+                                   'WHERE lsh_keys IS NULL').fetchall()
+            with conn:
+                conn.executemany('UPDATE translation_cache SET lsh_keys = ? WHERE rowid = ?',
+                                 [(pack_keys(band_keys(source_text or '')), rowid) for rowid, source_text in missing])
+            max_rowid = conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM translation_cache').fetchone()[0]
+            entries = [(rowid, unpack_keys(blob)) for rowid, blob in conn.execute(
+                'SELECT rowid, lsh_keys FROM translation_cache WHERE lsh_keys IS NOT NULL')]
+            entries.extend((entry_id | IMPORTED_FLAG, unpack_keys(blob)) for entry_id, blob in conn.execute(
+                'SELECT id, lsh_keys FROM fuzzy_imports WHERE lsh_keys IS NOT NULL'))
+        write_index(self.index_path, entries, max_rowid)
+
+    def refresh(self):
+        # Pick up the entries added to the cache since the last lookup
+        with self.cache.connection as conn:
+            rows = conn.execute('SELECT rowid, lsh_keys FROM translation_cache WHERE rowid > ? '
+                                'AND lsh_keys IS NOT NULL', (self.recent_rowid,)).fetchall()
+        for rowid, blob in rows:
+            for key in unpack_keys(blob):
+                self.recent.setdefault(key, []).append(rowid)
+            self.recent_rowid = max(self.recent_rowid, rowid)
+
+    def lookup_many(self, texts, target_lang, service=None, model=None):
+        # Return, for each text, up to max_matches (similarity, source_text, translated_text, service, model)
+        # translations into target_lang of similar texts, most similar first. When a source text was translated
+        # by several services, the translation by service and model is preferred.
+        if not self.loaded:
+            self.load()
+        results = [[] for _ in texts]
+        if self.index is None:
+            return results
+        try:
+            self.refresh()
+            with self.cache.connection as conn:
+                for i, text in enumerate(texts):
+                    keys = band_keys(text)
+                    if not keys:
+                        continue
+                    # Entries that share more bands are more likely to be close, so they are checked first
+                    hits = {}
+                    for rowid in self.index.candidates(keys):
+                        hits[rowid] = hits.get(rowid, 0) + 1
+                    for key in keys:
+                        for rowid in self.recent.get(key, ()):
+                            hits[rowid] = hits.get(rowid, 0) + 1
+                    if not hits:
+                        continue
+                    rowids = sorted(hits, key=hits.get, reverse=True)[:32]
+                    cache_rowids = [rowid for rowid in rowids if not rowid & IMPORTED_FLAG]
+                    import_ids = [rowid & ~IMPORTED_FLAG for rowid in rowids if rowid & IMPORTED_FLAG]
+                    rows = []
+                    if cache_rowids:
+                        rows += conn.execute(
+                            f'SELECT source_text, translated_text, service, model FROM translation_cache '
+                            f'WHERE lower(target_lang) = ? AND rowid IN ({",".join("?" * len(cache_rowids))})',
+                            [(target_lang or '').lower()] + cache_rowids).fetchall()
+                    if import_ids:
+                        rows += conn.execute(
+                            f"SELECT source_text, translated_text, 'imported', '' FROM fuzzy_imports "
+                            f'WHERE lower(target_lang) = ? AND id IN ({",".join("?" * len(import_ids))})',
+                            [(target_lang or '').lower()] + import_ids).fetchall()
+
+                    # Compare the candidates exactly and keep the best translation of each source text
+                    matches = {}
+                    for source_text, translated_text, match_service, match_model in rows:
+                        score = similarity(text, source_text)
+                        if score < self.threshold:
+                            continue
+                        preferred = (match_service, match_model) == (service, model)
+                        if source_text not in matches or preferred:
+                            matches[source_text] = (score, source_text, translated_text, match_service, match_model)
+                    results[i] = sorted(matches.values(), key=lambda match: match[0], reverse=True)[:self.max_matches]
+        except Exception as e:
+            print(f"Error reading the fuzzy translation memory: {e}")
+        return results
+
+    def reusable(self, text, match, service, model):
+        # Return the translation of a match that differs from text only in punctuation, case or spacing,
+        # with the closing punctuation of text, or None when the match can only serve as an example.
+        # Like the exact cache, only a translation by the same service and model is reused.
+        _, source_text, translated_text, match_service, match_model = match
+        if (match_service or '', match_model or '') != (service or '', model or ''):
+            return None
+        if word_key(text) != word_key(source_text) or normalize_text(text).count('\n') != source_text.count('\n'):
+            return None
+        return adapt_punctuation(normalize_text(text), source_text, translated_text)
+
+    def report(self):
+        # Summarize what the fuzzy matches saved during the run
+        return (f"Fuzzy translation memory: {self.reused} near-identical subtitles reused, "
+                f"{self.examples} subtitles sent with similar earlier translations as examples.")
+
+    def close(self):
+        # Release the index file
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+
+def import_movie_databases(memory, folders):
+    # Copy the translations stored in the movie databases under folders into the imported translations of the
+    # fuzzy memory, so every movie translated before the cache existed can be matched too; returns the number
+    # of subtitles copied
+    copied = 0
+    for folder in folders:
+        for root, _, file_names in os.walk(folder):
+            for file_name in file_names:
+                if not file_name.endswith('.db'):
+                    continue
+                db_path = os.path.join(root, file_name)
+                try:
+                    conn = sqlite3.connect(db_path)
+                    try:
+                        rows = conn.execute('''
+                            SELECT t.original_text, l.target_lang, l.translated_text
+                            FROM translations t
+                            JOIN language_translations l ON l.subtitle_index = t.subtitle_index
+                            WHERE l.translated_text IS NOT NULL AND l.translated_text != ''
+                        ''').fetchall()
+                    finally:
+                        conn.close()
+                except sqlite3.Error:
+                    # Not a movie database
+                    continue
+                by_lang = {}
+                for original_text, target_lang, translated_text in rows:
+                    if original_text:
+                        by_lang.setdefault(target_lang, []).append((original_text, translated_text))
+                for target_lang, entries in by_lang.items():
+                    memory.add_imports(entries, target_lang)
+                    copied += len(entries)
+                print(f"Imported {len(rows)} subtitles from {db_path}")
+    return copied
+
+
+def parse_args(argv=None):
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser(description="Build the fuzzy translation memory index of the translation "
+                                                 "cache.")
+    parser.add_argument("--cache", help="translation cache database (default: TRANSLATION_CACHE_PATH or "
+                                        "~/.srt_subtitle_translator/translation_cache.db)")
+    parser.add_argument("--import", dest="folders", nargs="*", default=[],
+                        help="folders to search for movie databases; their translations are added to the "
+                             "fuzzy memory as examples before the index is built")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    # translation_cache imports this module, so the cache class is imported only when the script runs
+    from translation_cache import TranslationCache
+    args = parse_args(argv)
+    cache = TranslationCache(args.cache)
+    try:
+        memory = FuzzyMemory(cache)
+        if args.folders:
+            print(f"Imported {import_movie_databases(memory, args.folders)} subtitles in total.")
+        start_time = time.perf_counter()
+        memory.build()
+        index = FuzzyIndex(memory.index_path)
+        print(f"Indexed {index.count // BANDS} cache entries and imported translations in {time.perf_counter() - start_time:.1f} s "
+              f"({os.path.getsize(memory.index_path) / 1024 / 1024:.1f} MB): {memory.index_path}")
+        index.close()
+    finally:
+        cache.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
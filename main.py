@@ -7,13 +7,23 @@ def main():
     # Load environment variables from a .env file
     load_dotenv()
 
-    # Retrieve the file path and target language from the environment variables
+    # Retrieve the file path and target languages from the environment variables
+    # TARGET_LANG may list several languages separated by commas, e.g. "fi,sv,nb"
     file_path = os.getenv('FILE_PATH')
-    target_lang = "fi"
+    target_langs = [lang.strip() for lang in os.getenv('TARGET_LANG', 'fi').split(',') if lang.strip()]
+    # Number of batches translated at the same time
+    concurrency = int(os.getenv('CONCURRENCY', 4))
+    # Pause in seconds that starts a new scene; scenes are translated in parallel, 0 turns them off
+    scene_gap = float(os.getenv('SCENE_GAP', 3.0))
+    # Smallest similarity at which a cached subtitle is offered as a near match; 0 turns fuzzy matching off
+    fuzzy_threshold = float(os.getenv('FUZZY_THRESHOLD', 0.7))
+    # Check the finished subtitles and translate the outliers again, unless QA_PASS is 0
+    qa = os.getenv('QA_PASS', '1').lower() not in ('0', 'false', 'no')
     print(file_path)  # Print the file path to verify it's been loaded correctly
 
-    # Create an instance of the Translator class with the specified file path and target language
-    translator = Translator(file_path, target_lang)
+    # Create an instance of the Translator class with the specified file path and target languages
+    translator = Translator(file_path, concurrency=concurrency, target_langs=target_langs, scene_gap=scene_gap,
+                            fuzzy_threshold=fuzzy_threshold, qa=qa)
 
     # Allow the user to select the translation service (e.g., OpenAI or DeepL)
     translator.select_translation_service()
@@ -30,6 +40,14 @@ def main():
     # Begin the process of translating the subtitles as per the user's inputs
     translator.process_srt(overwrite_translations)
 
+    # Write the run report when metrics are switched on with SRT_METRICS
+    metrics_dir = os.getenv('METRICS_DIR', translator.translations_path)
+    translator.export_metrics(os.path.join(metrics_dir, translator.movie_name + ".metrics.json"),
+                              os.path.join(metrics_dir, translator.movie_name + ".prom"))
+
+    # Release the database connection held by the translator
+    translator.close()
+
 
 if __name__ == "__main__":
     while True:
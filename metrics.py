@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class NoopStage:
+    # Returned by MetricsRecorder.stage when metrics are disabled, so timing a stage costs next to nothing
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NOOP_STAGE = NoopStage()
+
+
+class Stage:
+    def __init__(self, recorder, name):
+        # Time one run of a stage and report it to the recorder
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.recorder.observe(self.name, time.perf_counter() - self.start_time)
+        return False
+
+
+class Histogram:
+    def __init__(self):
+        # Cumulative counts per bucket as Prometheus expects them, plus the total count and sum
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, upper_bound in enumerate(BUCKETS):
+            if seconds <= upper_bound:
+                self.bucket_counts[i] += 1
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum_seconds": round(self.sum, 6),
+            "mean_seconds": round(self.sum / self.count, 6) if self.count else 0.0,
+            "max_seconds": round(self.max, 6),
+            "buckets": {str(upper_bound): count for upper_bound, count in zip(BUCKETS, self.bucket_counts)},
+        }
+
+
+def escape_label(value):
+    # Escape a Prometheus label value
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRecorder:
+    def __init__(self, enabled=False, labels=None):
+        # Collect stage latencies and event counters for one run; nothing is recorded while disabled
+        self.enabled = enabled
+        self.labels = dict(labels or {})
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        # Use as "with metrics.stage('provider_call'):" to time a stage
+        if not self.enabled:
+            return NOOP_STAGE
+        return Stage(self, name)
+
+    def observe(self, name, seconds):
+        # Record one duration of a stage
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1):
+        # Add to an event counter
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self):
+        # Return the run report as a dictionary
+        with self.lock:
+            return {
+                "labels": self.labels,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started)),
+                "duration_seconds": round(time.time() - self.started, 3),
+                "stages": {name: histogram.to_dict() for name, histogram in sorted(self.histograms.items())},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def write_json(self, file_path):
+        # Write the run report as JSON
+        with open(file_path, 'w', encoding='utf-8') as file:
+            json.dump(self.report(), file, indent=2)
+
+    def write_prometheus(self, file_path):
+        # Write the metrics in the Prometheus text format, for the node exporter's textfile collector
+        # The file is written under a temporary name and renamed, so the collector never reads half of it
+        base_labels = ','.join(f'{key}="{escape_label(value)}"' for key, value in sorted(self.labels.items()))
+        separator = ',' if base_labels else ''
+        lines = [
+            "# HELP srt_translator_stage_seconds Time spent in each stage of a translation run.",
+            "# TYPE srt_translator_stage_seconds histogram",
+        ]
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                labels = f'{base_labels}{separator}stage="{escape_label(name)}"'
+                for upper_bound, count in zip(BUCKETS, histogram.bucket_counts):
+                    lines.append(f'srt_translator_stage_seconds_bucket{{{labels},le="{upper_bound}"}} {count}')
+                lines.append(f'srt_translator_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'srt_translator_stage_seconds_sum{{{labels}}} {histogram.sum:.6f}')
+                lines.append(f'srt_translator_stage_seconds_count{{{labels}}} {histogram.count}')
+
+            lines.append("# HELP srt_translator_events_total Events counted during a translation run.")
+            lines.append("# TYPE srt_translator_events_total counter")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'srt_translator_events_total{{{base_labels}{separator}event="{escape_label(name)}"}} {value}')
+
+        temp_path = file_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, file_path)
+
+
+def timed_iter(iterable, recorder, name):
+    # Yield from iterable, recording the total time spent producing the items as one observation of name
+    if not recorder.enabled:
+        yield from iterable
+        return
+    elapsed = 0.0
+    iterator = iter(iterable)
+    while True:
+        start_time = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            elapsed += time.perf_counter() - start_time
+        yield item
+    recorder.observe(name, elapsed)
@@ -0,0 +1,204 @@
+import argparse
+import json
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mock_translator import MockProvider
+
+# A local stand-in for the OpenAI file and Batch API endpoints, so batch jobs can be tried without an account.
+# Start it and point the client at it with OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+
+
+class BatchState:
+    def __init__(self, provider, polls_until_done=1):
+        # Uploaded files and created jobs, kept in memory for the life of the server
+        # A job reports in_progress for polls_until_done status checks before it completes
+        self.provider = provider
+        self.polls_until_done = polls_until_done
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def add_file(self, content, filename, purpose):
+        # Store a file and return its OpenAI file object
+        with self.lock:
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = content
+        return {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        # Create a job for an uploaded input file and return its batch object
+        with self.lock:
+            if input_file_id not in self.files:
+                return None
+            batch_id = f"batch_{len(self.batches) + 1}"
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": endpoint, "input_file_id": input_file_id,
+                "completion_window": completion_window, "status": "in_progress", "output_file_id": None,
+                "error_file_id": None, "created_at": int(time.time()), "polls": 0,
+                "request_counts": {"total": 0, "completed": 0, "failed": 0}
+            }
+            return self.public(batch_id)
+
+    def retrieve_batch(self, batch_id):
+        # Return the batch object, running the job once it has been polled often enough
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            batch["polls"] += 1
+            if batch["status"] == "in_progress" and batch["polls"] > self.polls_until_done:
+                self.run(batch)
+            return self.public(batch_id)
+
+    def run(self, batch):
+        # Translate every request of the input file and store the replies as the output file
+        output_lines = []
+        counts = batch["request_counts"]
+        for line in self.files[batch["input_file_id"]].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            counts["total"] += 1
+            try:
+                content = self.provider.translate(request["body"]["messages"][-1]["content"], None)
+            except Exception as e:
+                counts["failed"] += 1
+                output_lines.append({"id": f"batch_req_{counts['total']}", "custom_id": request["custom_id"],
+                                     "response": {"status_code": 500, "body": {"error": {"message": str(e)}}},
+                                     "error": None})
+                continue
+            counts["completed"] += 1
+            prompt_tokens = sum(len(message["content"]) for message in request["body"]["messages"]) // 4
+            output_lines.append({
+                "id": f"batch_req_{counts['total']}", "custom_id": request["custom_id"], "error": None,
+                "response": {"status_code": 200, "request_id": f"req_{counts['total']}", "body": {
+                    "id": f"chatcmpl-{counts['total']}", "object": "chat.completion", "created": int(time.time()),
+                    "model": request["body"]["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                 "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                              "total_tokens": prompt_tokens + len(content) // 4}
+                }}
+            })
+
+        output_file_id = f"file-{len(self.files) + 1}"
+        self.files[output_file_id] = ''.join(json.dumps(line) + '\n' for line in output_lines).encode('utf-8')
+        batch["output_file_id"] = output_file_id
+        batch["status"] = "completed"
+
+    def public(self, batch_id):
+        # The batch object without the server's own bookkeeping
+        return {key: value for key, value in self.batches[batch_id].items() if key != "polls"}
+
+
+class BatchRequestHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def send_json(self, status, data):
+        # Reply with a JSON body
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_found(self):
+        # Reply the way the API does for an unknown id or path
+        self.send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+    def read_body(self):
+        # Read the request body
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        # Upload a file or create a batch job
+        path = self.path.split('?')[0]
+        if path == "/v1/files":
+            # The file arrives as multipart form data with a purpose field and a file field
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('utf-8') + self.read_body())
+            fields = {part.get_param('name', header='content-disposition'): part for part in message.iter_parts()}
+            if "file" not in fields:
+                self.send_json(400, {"error": {"message": "Missing file", "type": "invalid_request_error"}})
+                return
+            purpose = fields["purpose"].get_content().strip() if "purpose" in fields else "batch"
+            self.send_json(200, self.state.add_file(fields["file"].get_payload(decode=True),
+                                                    fields["file"].get_filename() or "upload.jsonl", purpose))
+        elif path == "/v1/batches":
+            data = json.loads(self.read_body() or b'{}')
+            batch = self.state.create_batch(data.get("input_file_id"), data.get("endpoint"),
+                                            data.get("completion_window"))
+            if batch is None:
+                self.not_found()
+            else:
+                self.send_json(200, batch)
+        else:
+            self.not_found()
+
+    def do_GET(self):
+        # Check a batch job or download a file
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) == 3 and parts[:2] == ["v1", "batches"]:
+            batch = self.state.retrieve_batch(parts[2])
+            if batch is None:
+                self.not_found()
+            else:
+                self.send_json(200, batch)
+        elif len(parts) == 4 and parts[:2] == ["v1", "files"] and parts[3] == "content":
+            content = self.state.files.get(parts[2])
+            if content is None:
+                self.not_found()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.not_found()
+
+    def log_message(self, format, *args):
+        # Keep the console quiet unless the server was started with --verbose
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def parse_args():
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the OpenAI Batch API.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765).")
+    parser.add_argument("--polls", type=int, default=1,
+                        help="Status checks a job stays in progress before it completes (default: 1).")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="Share of replies that lose or merge a subtitle (default: 0).")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Share of requests that fail inside the job (default: 0).")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the simulated failures.")
+    parser.add_argument("--verbose", action="store_true", help="Log every request.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    provider = MockProvider(latency=0, error_rate=args.error_rate, malformed_rate=args.malformed_rate,
+                            seed=args.seed)
+    BatchRequestHandler.state = BatchState(provider, args.polls)
+    server = ThreadingHTTPServer((args.host, args.port), BatchRequestHandler)
+    server.verbose = args.verbose
+    print(f"Serving the OpenAI Batch API stand-in on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import random
+import threading
+import time
+from batch_protocol import MARKER_RE
+from rate_limiter import RequestScheduler, FatalProviderError
+
+
+class MockProviderError(Exception):
+    # Stands in for a throttling or server error of a real provider
+    pass
+
+
+class MockProvider:
+    def __init__(self, latency=0.05, latency_per_char=0.0, error_rate=0.0, malformed_rate=0.0, seed=None):
+        # latency is the fixed time of one request in seconds, latency_per_char is added per source character,
+        # error_rate is the share of requests that raise and malformed_rate the share of replies that are broken
+        self.latency = latency
+        self.latency_per_char = latency_per_char
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # Statistics for the process
+        self.calls = 0
+        self.errors = 0
+        self.malformed = 0
+        self.characters = 0
+
+    def translate(self, original_text, target_lang):
+        # Pretend to translate by upper-casing every line, leaving [index] markers as they are
+        with self.lock:
+            self.calls += 1
+            self.characters += len(original_text)
+            fail = self.random.random() < self.error_rate
+            malform = self.random.random() < self.malformed_rate
+            if fail:
+                self.errors += 1
+            elif malform:
+                self.malformed += 1
+
+        time.sleep(self.latency + self.latency_per_char * len(original_text))
+        if fail:
+            raise MockProviderError("mock provider error")
+
+        translated_text = '\n'.join(line if MARKER_RE.match(line) else line.upper()
+                                    for line in original_text.split('\n'))
+        if malform:
+            translated_text = self.malform(translated_text)
+        return translated_text
+
+    def malform(self, text):
+        # Break the reply the way models do: merge two subtitles, or drop a marker line
+        if '\n\n' not in text:
+            return ''
+        if self.random.random() < 0.5:
+            return text.replace('\n\n', '\n', 1)
+        return MARKER_RE.sub('', text, count=1)
+
+    def stats(self):
+        return {"calls": self.calls, "errors": self.errors, "malformed": self.malformed,
+                "characters": self.characters}
+
+
+# The provider used by translate_mock; replace it with configure() before a run
+provider = MockProvider()
+# Mock errors are retried like real ones, but without long waits
+scheduler = RequestScheduler("Mock", base_delay=0.01, max_delay=0.1)
+
+
+def configure(**settings):
+    # Replace the mock provider with one using the given settings and return it
+    global provider
+    provider = MockProvider(**settings)
+    return provider
+
+
+def classify_mock_error(error):
+    # Every mock error is retryable
+    return isinstance(error, MockProviderError), None
+
+
+def translate_mock(original_text, target_lang):
+    try:
+        return scheduler.call(lambda: provider.translate(original_text, target_lang), classify_mock_error)
+    except FatalProviderError:
+        raise
+    except Exception as e:
+        print(f"Error during translation with the mock provider: {e}")
+        return None
+
+
+def translate(original_text, target_lang, **options):
+    # Provider entry point used by the Translator
+    return translate_mock(original_text, target_lang)
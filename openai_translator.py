@@ -1,40 +1,211 @@
+import json
+import os
+import threading
 import openai
 from dotenv import load_dotenv
+from rate_limiter import get_scheduler, parse_retry_after
 
 load_dotenv()
-client = openai.OpenAI()
-
-
-def translate_openai(original_text, target_lang, movie_name, context):
-    # print(original_text, target_lang, movie_name, subtitle_index, context)
-    print(context)
-
-    max_attempts = 3
-
-    for attempt in range(max_attempts):
-        try:
-            prompt = (
-                f"Translate the following subtitles from their original language to {target_lang} for the movie '{movie_name}', "
-                f"while preserving the context between sentences. Aim for an accurate translation that not only maintains the original text's meaning and emotion, "
-                f"but also uses genre-specific terminology and expressions appropriate for the film. Be natural and fluent for speakers of {target_lang}. "
-                f"Keep the structure, tone, and letter casing as in the original. "
-                f"Pay special attention to context and the flow between sentences, ensuring that the translated subtitles reflect the continuity of dialogue and narrative. "
-                f"Do not repeat the same text between text blocks. "
-                "Be precise and subtle in your translations, using liberties only as necessary to ensure the text's naturalness and fluency in the target language. "
-                "Incorporate genre-specific terms and expressions when appropriate to enhance the authenticity and richness of the translation.\n\n"
-                f"Previous translation (for context): {context}\n\n"
-            )
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo-0125",
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": original_text}
-                ]
-            )
-            translated_text = response.choices[0].message.content
-
-            return translated_text
-
-        except openai.APIError as e:
-            print(f"OpenAI API returned an error: {e}")
-            return None
+
+# One client, and so one pool of HTTP connections, is shared by every worker in the process.
+# It is created on first use, so importing this module does not need an API key.
+client = None
+client_lock = threading.Lock()
+
+# The chat model used for translations
+OPENAI_MODEL = "gpt-3.5-turbo-0125"
+
+# Requests and tokens per minute allowed for the account, shared by every worker in the process
+scheduler = get_scheduler(
+    "OpenAI",
+    requests_per_minute=int(os.getenv('OPENAI_REQUESTS_PER_MINUTE', 500)),
+    tokens_per_minute=int(os.getenv('OPENAI_TOKENS_PER_MINUTE', 200000))
+)
+
+# Token usage reported by the API for the process, including prompt tokens served from the provider's cache
+usage_stats = {"requests": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0}
+usage_lock = threading.Lock()
+
+# translate() takes the movie name, the context and the system prompt
+USES_CONTEXT = True
+
+
+def get_client():
+    # Return the shared client, creating it on first use
+    global client
+    with client_lock:
+        if client is None:
+            # Retries are handled by the shared scheduler, so the client does not retry on its own
+            client = openai.OpenAI(max_retries=0)
+        return client
+
+
+def model_name():
+    # The model used for translations
+    return OPENAI_MODEL
+
+
+def classify_openai_error(error):
+    # Rate limits, timeouts, connection problems and server errors are worth retrying; everything else is fatal
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True, None
+    if isinstance(error, openai.APIStatusError):
+        retryable = error.status_code in (408, 409, 429) or error.status_code >= 500
+        return retryable, parse_retry_after(error.response.headers) if retryable else None
+    return False, None
+
+
+def build_system_prompt(target_lang, movie_name, tagged=False):
+    # The instructions only depend on the movie, the language and the batch format, so they are built once
+    # per Translator and sent unchanged at the start of every request, where the provider can cache them
+    prompt = (
+        f"Translate the following subtitles from their original language to {target_lang} for the movie '{movie_name}', "
+        f"while preserving the context between sentences. Aim for an accurate translation that not only maintains the original text's meaning and emotion, "
+        f"but also uses genre-specific terminology and expressions appropriate for the film. Be natural and fluent for speakers of {target_lang}. "
+        f"Keep the structure, tone, and letter casing as in the original. "
+        f"Pay special attention to context and the flow between sentences, ensuring that the translated subtitles reflect the continuity of dialogue and narrative. "
+        f"Do not repeat the same text between text blocks. "
+        "Be precise and subtle in your translations, using liberties only as necessary to ensure the text's naturalness and fluency in the target language. "
+        "Incorporate genre-specific terms and expressions when appropriate to enhance the authenticity and richness of the translation.\n\n"
+        "Context about the surrounding subtitles may be given in a separate message before the subtitles. "
+        "Use it for consistency, but translate only the subtitles in the last message.\n\n"
+    )
+    if tagged:
+        # Each subtitle starts with its index in brackets, which is used to match the translations back
+        prompt += (
+            "Each subtitle starts with a marker line such as [12]. Copy every marker line unchanged on its own line "
+            "and write the translation of that subtitle under it. Do not merge, split or skip subtitles.\n\n"
+        )
+    return prompt
+
+
+def record_usage(response):
+    # Add the token usage of a response to usage_stats
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    add_usage(usage.prompt_tokens, getattr(details, 'cached_tokens', 0), usage.completion_tokens)
+
+
+def add_usage(prompt_tokens, cached_tokens, completion_tokens):
+    # Add the token counts of one request to usage_stats
+    with usage_lock:
+        usage_stats["requests"] += 1
+        usage_stats["prompt_tokens"] += prompt_tokens or 0
+        usage_stats["cached_prompt_tokens"] += cached_tokens or 0
+        usage_stats["completion_tokens"] += completion_tokens or 0
+
+
+def get_usage_stats():
+    # Return a copy of the token usage so far
+    with usage_lock:
+        return dict(usage_stats)
+
+
+def build_messages(original_text, target_lang, movie_name, context, tagged=False, upcoming='', system_prompt=None,
+                   examples=None):
+    # The static instructions come first; the context that changes with every batch and the subtitles come last
+    if system_prompt is None:
+        system_prompt = build_system_prompt(target_lang, movie_name, tagged)
+    messages = [{"role": "system", "content": system_prompt}]
+
+    context_prompt = f"Previous translation (for context): {context}\n\n" if context else ""
+    if examples:
+        # Earlier translations of similar lines from the translation memory, so recurring lines read the same
+        example_lines = '\n'.join(f"{source} => {translation}".replace('\n', ' / ')
+                                  for source, translation in examples)
+        context_prompt += (f"Earlier translations of similar lines (keep the wording where the lines agree):\n"
+                           f"{example_lines}\n\n")
+    if upcoming:
+        # The source subtitles after the batch help with sentences that continue past it
+        context_prompt += f"Upcoming original subtitles (for context only, do not translate): {upcoming}\n\n"
+    if context_prompt:
+        messages.append({"role": "system", "content": context_prompt})
+    messages.append({"role": "user", "content": original_text})
+    return messages
+
+
+def translate_openai(original_text, target_lang, movie_name, context, tagged=False, upcoming='', system_prompt=None,
+                     examples=None):
+    messages = build_messages(original_text, target_lang, movie_name, context, tagged, upcoming, system_prompt,
+                              examples)
+
+    def request():
+        return get_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages
+        )
+
+    # Roughly four characters per token, counting the prompts, the text and a reply as long as the text
+    estimated_tokens = (sum(len(message["content"]) for message in messages) + len(original_text)) // 4
+
+    try:
+        response = scheduler.call(request, classify_openai_error, estimated_tokens)
+        record_usage(response)
+        translated_text = response.choices[0].message.content
+
+        return translated_text
+
+    except openai.APIError as e:
+        # Errors that were retried until the retries ran out; a FatalProviderError, such as for a bad key,
+        # an exhausted quota or a rejected request, is passed on so the batch is failed without more attempts
+        print(f"OpenAI API returned an error: {e}")
+        return None
+
+
+def build_batch_request(custom_id, original_text, target_lang, movie_name, context, tagged=True, system_prompt=None,
+                        examples=None):
+    # One line of a Batch API input file: the same chat request translate_openai would send
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": OPENAI_MODEL,
+            "messages": build_messages(original_text, target_lang, movie_name, context, tagged,
+                                       system_prompt=system_prompt, examples=examples)
+        }
+    }
+
+
+def submit_batch(requests):
+    # Upload the requests as a JSONL file and start a Batch API job; returns the job id
+    jsonl_text = '\n'.join(json.dumps(request, ensure_ascii=False) for request in requests) + '\n'
+    input_file = get_client().files.create(file=("batch.jsonl", jsonl_text.encode('utf-8')), purpose="batch")
+    batch = get_client().batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                  completion_window="24h")
+    return batch.id
+
+
+def retrieve_batch(job_id):
+    # Return the Batch API job with its status and output file ids
+    return get_client().batches.retrieve(job_id)
+
+
+def download_batch_results(file_id):
+    # Read a Batch API output file into {custom_id: translated text}; requests that failed map to None
+    results = {}
+    if not file_id:
+        return results
+    for line in get_client().files.content(file_id).text.splitlines():
+        if not line.strip():
+            continue
+        data = json.loads(line)
+        response = data.get("response") or {}
+        body = response.get("body") or {}
+        if response.get("status_code") == 200 and body.get("choices"):
+            results[data["custom_id"]] = body["choices"][0]["message"]["content"]
+            usage = body.get("usage") or {}
+            add_usage(usage.get("prompt_tokens"), (usage.get("prompt_tokens_details") or {}).get("cached_tokens"),
+                      usage.get("completion_tokens"))
+        else:
+            results[data["custom_id"]] = None
+    return results
+
+
+def translate(original_text, target_lang, movie_name='', context='', tagged=False, upcoming='', system_prompt=None,
+              examples=None):
+    # Provider entry point used by the Translator
+    return translate_openai(original_text, target_lang, movie_name, context, tagged, upcoming, system_prompt,
+                            examples)
@@ -0,0 +1,67 @@
+import importlib
+import os
+import threading
+
+# Translation services by name, with the module that implements each one and the name shown in the menu.
+# A provider module is imported only when its service is first used, so the SDKs of unused services are never loaded.
+#
+# Every provider module has translate(original_text, target_lang, **options) returning the translated text or None.
+# Errors that retrying will not fix, such as a bad API key, are raised as rate_limiter.FatalProviderError instead.
+# It may also have:
+#   model_name()                     the model behind the service, used to keep cached translations apart
+#   USES_CONTEXT = True              translate() takes movie_name, context, upcoming, tagged, system_prompt and
+#                                    examples, a list of (source, translation) pairs of similar earlier lines
+#   build_system_prompt(...)         the fixed instructions of a service that uses context
+#   translate_list(texts, target_lang, glossary_id)
+#                                    one translation per text, with MAX_LIST_TEXTS and MAX_LIST_CHARS per request
+#   ensure_glossary(...), delete_glossary(...), read_glossary_entries(...), glossary_hash(...)
+#                                    glossaries made from a glossary file next to the SRT file
+#   get_usage_stats()                token counts, for the prompt cache report
+#   build_batch_request(...), submit_batch(...), retrieve_batch(...), download_batch_results(...)
+#                                    offline batch jobs
+providers = {}
+loaded_modules = {}
+lock = threading.Lock()
+
+
+def register_provider(name, module_name, label=None, menu=True):
+    # Make a translation service available under name; menu decides whether the interactive menu offers it
+    providers[name] = {"module": module_name, "label": label or name, "menu": menu}
+
+
+def get_provider(name):
+    # Return the module of a translation service, importing it on first use
+    with lock:
+        if name not in loaded_modules:
+            if name not in providers:
+                raise ValueError(f"Unknown translation service: {name}")
+            loaded_modules[name] = importlib.import_module(providers[name]["module"])
+        return loaded_modules[name]
+
+
+def provider_names():
+    # Names of all registered translation services
+    return list(providers)
+
+
+def menu_providers():
+    # (name, label) of the services offered in the interactive menu, in registration order
+    return [(name, provider["label"]) for name, provider in providers.items() if provider["menu"]]
+
+
+def register_plugins(spec=None):
+    # Register extra services from a "name=module,name=module" list, by default the TRANSLATION_PROVIDERS
+    # environment variable, so new services can be added without editing this project
+    spec = os.getenv("TRANSLATION_PROVIDERS", "") if spec is None else spec
+    for entry in spec.split(','):
+        if '=' in entry:
+            name, module_name = (part.strip() for part in entry.split('=', 1))
+            if name and module_name:
+                register_provider(name, module_name)
+
+
+register_provider("openai", "openai_translator", "OpenAI")
+register_provider("deepl", "deepl_translator", "DeepL")
+# Local stand-in provider used by the benchmarks
+register_provider("mock", "mock_translator", "Local mock", menu=False)
+register_plugins()
@@ -0,0 +1,151 @@
+import os
+import random
+import threading
+import time
+
+
+class FatalProviderError(Exception):
+    # An error that will not go away by retrying, such as a bad API key, an exhausted quota or a rejected request;
+    # providers let it through instead of returning None, so the batch is failed without further attempts
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute, burst_seconds=10):
+        # Refill per_minute units evenly over a minute, allowing a burst of burst_seconds worth of units
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        # Wait until amount units are available and take them; requests larger than the bucket take all of it
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_time = (amount - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class RequestScheduler:
+    def __init__(self, name, requests_per_minute=0, tokens_per_minute=0, max_retries=6, base_delay=1.0,
+                 max_delay=60.0):
+        # Limits of 0 mean no limit
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        # When the provider asks to slow down, every worker waits until this moment
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+        # Statistics for the process
+        self.requests = 0
+        self.retries = 0
+
+    def pause(self, seconds):
+        # Stop every worker from sending requests for the given number of seconds
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_for_slot(self, estimated_tokens):
+        # Respect a pause set by another worker, then take a request and the estimated tokens from the buckets
+        while True:
+            with self.lock:
+                wait_time = self.paused_until - time.monotonic()
+            if wait_time <= 0:
+                break
+            time.sleep(wait_time)
+
+        if self.request_bucket is not None:
+            self.request_bucket.acquire(1)
+        if self.token_bucket is not None and estimated_tokens:
+            self.token_bucket.acquire(estimated_tokens)
+
+    def backoff_delay(self, retry_number, retry_after=None):
+        # Use the delay the provider asked for, or exponential backoff with full jitter
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry_number))
+
+    def call(self, request, classify_error, estimated_tokens=0):
+        # Run request() within the limits, retrying errors that classify_error marks as retryable
+        # classify_error(exception) returns (retryable, retry_after_seconds or None); an error that is not
+        # retryable is raised as FatalProviderError, and the last error once the retries run out as it is
+        retry_number = 0
+        while True:
+            self.wait_for_slot(estimated_tokens)
+            with self.lock:
+                self.requests += 1
+            try:
+                return request()
+            except Exception as e:
+                retryable, retry_after = classify_error(e)
+                if not retryable:
+                    raise FatalProviderError(f"{self.name} request failed: {e}") from e
+                if retry_number >= self.max_retries:
+                    raise
+
+                delay = self.backoff_delay(retry_number, retry_after)
+                retry_number += 1
+                with self.lock:
+                    self.retries += 1
+                print(f"{self.name} request failed ({e}), retrying in {delay:.1f} s "
+                      f"(retry {retry_number}/{self.max_retries}).")
+
+                # A provider-supplied delay applies to everybody, so all workers wait for it
+                if retry_after is not None:
+                    self.pause(delay)
+                else:
+                    time.sleep(delay)
+
+
+# Environment variables with the per-minute limits of the accounts, and their defaults (0 means no limit)
+RATE_LIMIT_VARIABLES = {
+    'OPENAI_REQUESTS_PER_MINUTE': 500,
+    'OPENAI_TOKENS_PER_MINUTE': 200000,
+    'DEEPL_REQUESTS_PER_MINUTE': 0,
+}
+
+
+def share_rate_limits(processes):
+    # Set this process's limits to its share of the account limits when processes worker processes translate
+    # at the same time; must run before a provider module builds its scheduler
+    for name, default in RATE_LIMIT_VARIABLES.items():
+        limit = int(os.getenv(name, default))
+        if limit:
+            os.environ[name] = str(max(1, limit // processes))
+
+
+# One scheduler per provider, shared by every worker thread in the process
+schedulers = {}
+schedulers_lock = threading.Lock()
+
+
+def get_scheduler(name, requests_per_minute=0, tokens_per_minute=0):
+    # Return the scheduler for the provider, creating it on first use
+    with schedulers_lock:
+        if name not in schedulers:
+            schedulers[name] = RequestScheduler(name, requests_per_minute, tokens_per_minute)
+        return schedulers[name]
+
+
+def parse_retry_after(headers):
+    # Read a Retry-After header given in seconds; HTTP dates are ignored in favour of backoff
+    if not headers:
+        return None
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
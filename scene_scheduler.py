@@ -0,0 +1,107 @@
+from bisect import bisect_right
+from srt_parser import parse_timestamp_line
+
+
+def split_scenes(timings, gap_ms=3000, max_cues=100, min_cues=5):
+    # Split (subtitle_index, start_ms, end_ms) timings, in index order, into scenes and return their
+    # (first_index, last_index) ranges. A scene ends where the silence before the next subtitle is at least
+    # gap_ms. Scenes shorter than min_cues are joined to the one before, so a lone line between two silences
+    # does not become a request of its own. Scenes longer than max_cues are split again at their longest
+    # silence, so one long scene does not make the whole film wait for it.
+    scenes = []
+    current = []
+    for timing in timings:
+        if len(current) >= min_cues and timing[1] - current[-1][2] >= gap_ms:
+            scenes.append(current)
+            current = []
+        current.append(timing)
+    if current:
+        if scenes and len(current) < min_cues:
+            scenes[-1].extend(current)
+        else:
+            scenes.append(current)
+
+    ranges = []
+    pending = scenes[::-1]
+    while pending:
+        scene = pending.pop()
+        if max_cues and len(scene) > max_cues:
+            # Split at the longest silence, ignoring the first and last few subtitles so no piece is tiny
+            margin = min(len(scene) // 4, max_cues // 4)
+            split = max(range(margin + 1, len(scene) - margin),
+                        key=lambda position: scene[position][1] - scene[position - 1][2])
+            pending.extend([scene[split:], scene[:split]])
+            continue
+        ranges.append((scene[0][0], scene[-1][0]))
+    return ranges
+
+
+def timings_from_timestamps(rows):
+    # Turn stored (subtitle_index, timestamp) rows into (subtitle_index, start_ms, end_ms) timings;
+    # a subtitle whose timestamp does not parse is treated as following the previous one without a gap
+    timings = []
+    for subtitle_index, timestamp in rows:
+        parsed = parse_timestamp_line(timestamp)
+        if parsed is None:
+            previous_end = timings[-1][2] if timings else 0
+            parsed = (previous_end, previous_end)
+        timings.append((subtitle_index, parsed[0], parsed[1]))
+    return timings
+
+
+class SceneIndex:
+    def __init__(self, ranges):
+        # ranges are the (first_index, last_index) ranges of the scenes, in order
+        self.ranges = ranges
+        self.starts = [first_index for first_index, _ in ranges]
+
+    def bounds(self, subtitle_index):
+        # Return the (first_index, last_index) of the scene holding subtitle_index, or (None, None)
+        position = bisect_right(self.starts, subtitle_index) - 1
+        if position < 0 or subtitle_index > self.ranges[position][1]:
+            return None, None
+        return self.ranges[position]
+
+    def group_rows(self, rows):
+        # Split rows, in index order, into lists of rows that belong to the same scene
+        groups = []
+        current_scene = None
+        for row in rows:
+            scene = self.bounds(row[0])
+            if not groups or scene != current_scene or scene == (None, None):
+                groups.append([])
+                current_scene = scene
+            groups[-1].append(row)
+        return groups
+
+
+class SceneScheduler:
+    def __init__(self, units, sequential=True):
+        # units is a list of (target_lang, batches) pairs, where batches iterates over the batches of one scene.
+        # When sequential is True a scene has only one batch in flight, so every batch is translated after
+        # the batch before it in the same scene and gets its translation as context;
+        # different scenes do not depend on each other and run in parallel.
+        self.units = [{'target_lang': target_lang, 'batches': iter(batches), 'busy': False}
+                      for target_lang, batches in units]
+        self.sequential = sequential
+
+    def next_batch(self):
+        # Return (unit, target_lang, batch) for the earliest batch that may start now, or None
+        position = 0
+        while position < len(self.units):
+            unit = self.units[position]
+            if unit['busy']:
+                position += 1
+                continue
+            batch = next(unit['batches'], None)
+            if batch is None:
+                # The scene has no batches left
+                self.units.pop(position)
+                continue
+            unit['busy'] = self.sequential
+            return unit, unit['target_lang'], batch
+        return None
+
+    def finished(self, unit):
+        # Let the next batch of the unit's scene start
+        unit['busy'] = False
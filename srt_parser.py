@@ -0,0 +1,179 @@
+import codecs
+import hashlib
+import io
+import re
+from collections import namedtuple
+
+# One subtitle cue; start_ms and end_ms are the timings in integer milliseconds
+SubtitleCue = namedtuple('SubtitleCue', ['index', 'start_ms', 'end_ms', 'timestamp', 'text'])
+
+# Precompiled patterns, so they are not looked up for every cue
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+TIMESTAMP_RE = re.compile(
+    r'^\s*(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})\s*-->\s*(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})')
+
+# Number of bytes inspected when detecting the encoding
+ENCODING_SAMPLE_SIZE = 64 * 1024
+# Encoding used when the file is not valid UTF-8
+LEGACY_ENCODING = 'ISO-8859-1'
+
+
+def clean_html_tags(text):
+    # Remove HTML tags such as <i> and <font> from the text
+    return HTML_TAG_RE.sub('', text)
+
+
+def normalize_text(text):
+    # Collapse the whitespace inside each line and strip the text, but keep the line structure
+    return '\n'.join(' '.join(line.split()) for line in text.strip().split('\n'))
+
+
+def content_hash(text):
+    # Fingerprint of a cue's text that ignores whitespace changes, used to match cues of a re-released file
+    return hashlib.sha1(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+def file_hash(file_path, chunk_size=1024 * 1024):
+    # Fingerprint of a whole file, used to notice that the source file has changed
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def detect_encoding(sample):
+    # A byte order mark tells the encoding directly
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith(codecs.BOM_UTF16_LE) or sample.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16'
+
+    # Otherwise use UTF-8 if the sample decodes cleanly; a character cut off at the end of the sample is allowed
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return LEGACY_ENCODING
+
+
+def timestamp_to_ms(hours, minutes, seconds, fraction):
+    # Convert the parts of an SRT timestamp to milliseconds; ",5" means 500 ms
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(fraction.ljust(3, '0'))
+
+
+def parse_timestamp_line(timestamp):
+    # Return (start_ms, end_ms) of a stored "00:00:01,000 --> 00:00:02,000" line, or None if it does not parse
+    match = TIMESTAMP_RE.match(timestamp or '')
+    if match is None:
+        return None
+    groups = match.groups()
+    return timestamp_to_ms(*groups[:4]), timestamp_to_ms(*groups[4:])
+
+
+def ms_to_timestamp(ms):
+    # Format milliseconds as an SRT timestamp, e.g. 01:02:03,456
+    seconds, ms = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{ms:03d}"
+
+
+class PrefixedStream(io.RawIOBase):
+    def __init__(self, prefix, stream):
+        # Replay bytes that were already read for encoding detection before the rest of the stream
+        self.prefix = prefix
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.prefix:
+            size = min(len(buffer), len(self.prefix))
+            buffer[:size] = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+            return size
+        data = self.stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def open_text(source, encoding=None):
+    # Text streams are used as they are
+    if isinstance(source, io.TextIOBase):
+        return source, False
+
+    # Paths are opened in binary mode so the encoding can be detected from the raw bytes
+    close_when_done = False
+    if isinstance(source, (str, bytes)) or hasattr(source, '__fspath__'):
+        source = open(source, 'rb')
+        close_when_done = True
+
+    # Read a sample for the detection and make sure those bytes are read again when parsing
+    if encoding is None:
+        sample = source.read(ENCODING_SAMPLE_SIZE)
+        encoding = detect_encoding(sample)
+        if source.seekable():
+            source.seek(0)
+        else:
+            source = io.BufferedReader(PrefixedStream(sample, source))
+
+    # Universal newlines turn CRLF and CR line endings into '\n'
+    text_stream = io.TextIOWrapper(source, encoding=encoding, errors='replace', newline=None)
+    return text_stream, close_when_done
+
+
+def iter_srt_cues(source, encoding=None):
+    # Yield the cues of an SRT file one at a time, reading the file in a single pass
+    # source can be a file path, a binary file object or a text file object
+    text_stream, close_when_done = open_text(source, encoding)
+
+    previous_index = 0
+    current = None  # [index, start_ms, end_ms, timestamp, text lines] of the cue being read
+    pending_number = None  # A number line that is a cue index only if a timestamp follows it
+
+    def finish(cue):
+        # Blank lines inside a cue would break the batch format, so only non-empty lines are kept
+        return SubtitleCue(cue[0], cue[1], cue[2], cue[3], '\n'.join(line for line in cue[4] if line))
+
+    try:
+        for line in text_stream:
+            # Drop the line ending, trailing whitespace and a byte order mark left by a text stream
+            line = line.rstrip().lstrip('\ufeff')
+
+            if pending_number is not None:
+                match = TIMESTAMP_RE.match(line)
+                if match:
+                    if current is not None:
+                        yield finish(current)
+
+                    # Keep the index from the file unless it would break the ordering, then renumber
+                    index = int(pending_number)
+                    if index <= previous_index:
+                        index = previous_index + 1
+                    previous_index = index
+
+                    groups = match.groups()
+                    current = [index, timestamp_to_ms(*groups[:4]), timestamp_to_ms(*groups[4:]), line.strip(), []]
+                    pending_number = None
+                    continue
+
+                # The number was part of the subtitle text after all
+                if current is not None:
+                    current[4].append(pending_number)
+                pending_number = None
+
+            if line.strip().isdigit():
+                pending_number = line.strip()
+            elif current is not None:
+                current[4].append(line)
+
+        # A number on the last line belongs to the text of the last cue
+        if current is not None:
+            if pending_number is not None:
+                current[4].append(pending_number)
+            yield finish(current)
+    finally:
+        if close_when_done:
+            text_stream.close()
@@ -0,0 +1,249 @@
+import argparse
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from batch_builder import BatchBuilder
+from batch_protocol import encode_rows, decode_reply
+from batch_retry import translate_with_retries, MAX_ATTEMPTS
+from context_window import ContextWindow
+from providers import get_provider, provider_names
+from srt_parser import iter_srt_cues, clean_html_tags, ms_to_timestamp
+
+# Translate an SRT file or stream into another SRT stream without the movie database: the cues are read,
+# batched, translated and written out in one pass, holding only the batches in flight in memory.
+# Nothing is written to SQLite, so there is no resume, translation cache or fuzzy matching in this mode;
+# cues whose translation fails keep their original text.
+#
+#   python stream_translate.py -t fi -s deepl movie.srt -o movie.fi.srt
+#   ffmpeg -i movie.mkv -map 0:s:0 -f srt - | python stream_translate.py -t fi -s openai > movie.fi.srt
+
+
+class StreamCue:
+    # One cue in memory; timings are integer milliseconds
+    __slots__ = ('index', 'start_ms', 'end_ms', 'text', 'translation')
+
+    def __init__(self, index, start_ms, end_ms, text):
+        self.index = index
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.text = text
+        self.translation = None
+
+    def to_srt(self):
+        # The cue as an SRT block, with the translation if there is one
+        text = self.translation if self.translation is not None else self.text
+        return f"{self.index}\n{ms_to_timestamp(self.start_ms)} --> {ms_to_timestamp(self.end_ms)}\n{text}\n\n"
+
+
+def read_cues(source):
+    # Yield the cues of an SRT path or binary stream as StreamCue objects, without HTML tags
+    for cue in iter_srt_cues(source):
+        yield StreamCue(cue.index, cue.start_ms, cue.end_ms, clean_html_tags(cue.text))
+
+
+def iter_scenes(cues, gap_ms, max_cues):
+    # Group the cues into scenes at pauses of at least gap_ms, cutting scenes at max_cues so memory stays bounded
+    scene = []
+    for cue in cues:
+        if scene and ((gap_ms and cue.start_ms - scene[-1].end_ms >= gap_ms) or len(scene) >= max_cues):
+            yield scene
+            scene = []
+        scene.append(cue)
+    if scene:
+        yield scene
+
+
+class StreamTranslator:
+    def __init__(self, service, target_lang, movie_name='', batch_size=20, char_budget=1500, concurrency=4,
+                 context_size=3, scene_gap=3.0, max_attempts=MAX_ATTEMPTS, glossary_path=None):
+        # Translate cues with the named service into target_lang.
+        # concurrency batches are translated at the same time; with a concurrency of 1 every batch gets the
+        # translations before it in its scene as context
+        self.service = service
+        self.provider = get_provider(service)
+        self.target_lang = target_lang
+        self.movie_name = movie_name
+        self.batch_size = batch_size
+        self.concurrency = max(1, concurrency)
+        self.scene_gap_ms = int((scene_gap or 0) * 1000)
+        self.max_attempts = max_attempts
+        self.list_mode = hasattr(self.provider, 'translate_list')
+        if self.list_mode:
+            # List requests are only limited by their size, as in Translator.get_batch_builder
+            self.batch_builder = BatchBuilder(self.provider.MAX_LIST_CHARS, max_budget=self.provider.MAX_LIST_CHARS,
+                                              adaptive=False)
+        else:
+            self.batch_builder = BatchBuilder(char_budget)
+        # Only the recent translations are kept for context
+        self.context_window = ContextWindow(context_size, max_entries=1000)
+        self.system_prompt = None
+        if getattr(self.provider, 'USES_CONTEXT', False) and hasattr(self.provider, 'build_system_prompt'):
+            self.system_prompt = self.provider.build_system_prompt(target_lang, movie_name, True)
+
+        # A glossary file is made into a glossary for this run only, as there is no database to remember it in
+        self.glossary_id = None
+        if glossary_path and hasattr(self.provider, 'ensure_glossary'):
+            entries = self.provider.read_glossary_entries(glossary_path)
+            if entries:
+                self.glossary_id = self.provider.ensure_glossary(movie_name or 'stream', target_lang, entries)
+
+        # Statistics for the run
+        self.stats = {'cues': 0, 'batches': 0, 'calls': 0, 'failed': 0}
+        self.stats_lock = threading.Lock()
+
+    def request_translation(self, rows, first_index):
+        # Send the rows once and return (results, missing_rows, replied), like Translator.request_translation
+        with self.stats_lock:
+            self.stats['calls'] += 1
+        batch_format = 'list' if self.list_mode else 'tagged'
+        batch = encode_rows(rows, batch_format)
+        if self.list_mode:
+            translated_text = self.provider.translate_list(batch, self.target_lang, self.glossary_id)
+        elif getattr(self.provider, 'USES_CONTEXT', False):
+            translated_text = self.provider.translate(
+                batch, self.target_lang, movie_name=self.movie_name,
+                context=self.context_window.previous(self.target_lang, rows[0][0], first_index),
+                tagged=True, system_prompt=self.system_prompt)
+        else:
+            translated_text = self.provider.translate(batch, self.target_lang)
+        results, missing_rows = decode_reply(translated_text, rows, batch_format)
+        return results, missing_rows, translated_text is not None
+
+    def translate_batch(self, cues, first_index):
+        # Translate a batch of cues in place; first_index is the first cue of the scene, where context stops.
+        # Missing rows are resent and failing batches split the same way as in the Translator.
+        start_time = time.perf_counter()
+        rows = [(cue.index, cue.text) for cue in cues]
+        results, failed_rows = translate_with_retries(
+            lambda batch_rows, attempt: self.request_translation(batch_rows, first_index), rows, self.max_attempts)
+        self.batch_builder.record(time.perf_counter() - start_time, not failed_rows)
+        self.context_window.add(self.target_lang, results)
+        translations = dict(results)
+        for cue in cues:
+            cue.translation = translations.get(cue.index)
+        if failed_rows:
+            print(f"Keeping the original text of {len(failed_rows)} lines in {cues[0].index}-{cues[-1].index}.")
+        return len(failed_rows)
+
+    def iter_batches(self, cues):
+        # Yield (cues, first_index_of_scene) batches that never cross a scene break
+        max_cues = self.provider.MAX_LIST_TEXTS if self.list_mode else self.batch_size
+        for scene in iter_scenes(cues, self.scene_gap_ms, max(max_cues, 100)):
+            by_index = {cue.index: cue for cue in scene}
+            rows = [(cue.index, cue.text) for cue in scene]
+            for batch in self.batch_builder.iter_batches(rows, max_cues):
+                yield [by_index[row[0]] for row in batch], scene[0].index
+
+    def run(self, source, output):
+        # Translate the cues from source and write them to the text stream output in order,
+        # each batch as soon as it and every batch before it are done
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for cues, first_index in self.iter_batches(read_cues(source)):
+                pending.append((cues, executor.submit(self.translate_batch, cues, first_index)))
+                self.stats['batches'] += 1
+                # Only a few batches are held at a time; the oldest is written before the next one is read
+                while len(pending) >= self.concurrency:
+                    self.write_batch(pending.popleft(), output)
+            while pending:
+                self.write_batch(pending.popleft(), output)
+
+    def write_batch(self, entry, output):
+        # Wait for a batch and write its cues
+        cues, future = entry
+        try:
+            self.stats['failed'] += future.result()
+        except Exception as e:
+            # Like in the Translator, an unexpected error fails only its batch, which keeps the original text
+            print(f"Error translating lines {cues[0].index}-{cues[-1].index}: {e}")
+            self.stats['failed'] += len(cues)
+        self.stats['cues'] += len(cues)
+        output.write(''.join(cue.to_srt() for cue in cues))
+        output.flush()
+
+    def close(self):
+        # Remove the glossary made for the run
+        if self.glossary_id:
+            self.provider.delete_glossary(self.glossary_id)
+
+
+def parse_args(argv=None):
+    # Parse the command line arguments
+    parser = argparse.ArgumentParser(description="Translate an SRT file or stream without the subtitle database.")
+    parser.add_argument("input", nargs="?", default="-", help="SRT file to translate, or - for stdin (default)")
+    parser.add_argument("-o", "--output", default="-", help="file to write, or - for stdout (default)")
+    parser.add_argument("-t", "--target-lang", required=True, help="target language code, e.g. fi")
+    parser.add_argument("-s", "--service", choices=provider_names(), default="deepl",
+                        help="translation service (default deepl)")
+    parser.add_argument("-b", "--batch-size", type=int, default=20, help="maximum subtitles per request (default 20)")
+    parser.add_argument("--char-budget", type=int, default=1500,
+                        help="starting size of a request in characters (default 1500)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4,
+                        help="requests at the same time; 1 gives every batch the one before it as context (default 4)")
+    parser.add_argument("--scene-gap", type=float, default=3.0,
+                        help="pause in seconds that starts a new scene; batches and context stay within a scene, "
+                             "0 turns scenes off (default 3)")
+    parser.add_argument("--movie-name", help="title given to the translation service (default: the file name)")
+    parser.add_argument("--glossary", help="glossary TSV file with source<TAB>translation lines, for DeepL")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    movie_name = args.movie_name
+    if movie_name is None:
+        movie_name = os.path.splitext(os.path.basename(args.input))[0] if args.input != "-" else ""
+
+    # When the subtitles go to stdout, every message goes to stderr so the output stays a clean SRT stream
+    to_stdout = args.output == "-"
+    messages = contextlib.redirect_stdout(sys.stderr) if to_stdout else contextlib.nullcontext()
+    if to_stdout:
+        output = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+        temp_path = None
+    else:
+        # Write to a temporary file first and rename it at the end, so a failed run never leaves half a file
+        temp_path = args.output + ".tmp"
+        output = open(temp_path, 'w', encoding='utf-8', buffering=1024 * 1024)
+    source = sys.stdin.buffer if args.input == "-" else args.input
+
+    start_time = time.perf_counter()
+    with messages:
+        translator = None
+        finished = False
+        try:
+            translator = StreamTranslator(args.service, args.target_lang, movie_name, args.batch_size,
+                                          args.char_budget, args.concurrency, scene_gap=args.scene_gap,
+                                          glossary_path=args.glossary)
+            translator.run(source, output)
+            finished = True
+        except Exception as e:
+            print(f"Error translating the stream: {e}")
+        finally:
+            if translator is not None:
+                translator.close()
+            if to_stdout:
+                output.flush()
+                output.detach()
+            else:
+                output.close()
+
+        if temp_path is not None:
+            if not finished:
+                os.remove(temp_path)
+                return 1
+            os.replace(temp_path, args.output)
+        if not finished:
+            return 1
+        stats = translator.stats
+        print(f"Translated {stats['cues']} subtitles in {stats['batches']} batches with {stats['calls']} requests "
+              f"in {time.perf_counter() - start_time:.1f} s; {stats['failed']} kept their original text.")
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,182 @@
+import time
+from srt_parser import parse_timestamp_line
+
+# NumPy is optional and imported on first use, so runs with the QA pass turned off never load it;
+# without it the QA pass is skipped
+np = None
+
+# Limits a finished subtitle should stay within; the defaults follow common streaming style guides
+DEFAULT_LIMITS = {
+    'max_cps': 20.0,          # characters per second of display time
+    'max_line_length': 42,    # characters on one line
+    'max_lines': 2,           # lines in one subtitle
+    'min_ratio': 0.3,         # translation length divided by source length
+    'max_ratio': 3.0,
+    'min_ratio_chars': 12,    # shorter sources vary too much in length to judge the ratio
+    'min_untranslated_chars': 12,  # short lines such as names are often the same in both languages
+    'outlier_factor': 1.5,    # how much longer than the file's typical translation a wordy one is
+}
+
+# Issues that a new translation can fix, so their subtitles are sent again
+REQUEUE_ISSUES = ('empty', 'untranslated', 'length_ratio', 'too_many_lines')
+# Issues that are only sent again when the translation is also much wordier than is usual for the file,
+# since a language that needs more characters makes many subtitles a little too long or fast
+WORDY_ISSUES = ('long_line', 'reading_speed')
+
+# Value in milliseconds of every character of a standard "00:00:01,000 --> 00:00:02,500" timestamp line,
+# for the start and the end time; the other characters are separators
+TIMESTAMP_WIDTH = 29
+START_WEIGHTS = [36000000, 3600000, 0, 600000, 60000, 0, 10000, 1000, 0, 100, 10, 1] + [0] * 17
+END_WEIGHTS = [0] * 17 + START_WEIGHTS[:12]
+DIGIT_POSITIONS = [position for position in range(TIMESTAMP_WIDTH)
+                   if START_WEIGHTS[position] or END_WEIGHTS[position]]
+
+
+def load_numpy():
+    # Import NumPy on first use; returns False if it is not installed
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return True
+
+
+def is_available():
+    # The QA pass needs NumPy
+    return load_numpy()
+
+
+def parse_timings(timestamps):
+    # Return (start_ms, end_ms) arrays for the timestamp lines. Standard fixed-width lines are parsed together
+    # from their bytes; any other line is parsed on its own.
+    load_numpy()
+    count = len(timestamps)
+    start_ms = np.zeros(count, dtype=np.int64)
+    end_ms = np.zeros(count, dtype=np.int64)
+    try:
+        raw = np.array(timestamps, dtype=f'S{TIMESTAMP_WIDTH + 1}')
+    except UnicodeEncodeError:
+        raw = None
+    if raw is not None and count:
+        characters = raw.view(np.uint8).reshape(count, TIMESTAMP_WIDTH + 1)
+        # A standard line is exactly TIMESTAMP_WIDTH long with a digit in every digit position;
+        # the subtraction wraps around below '0', so one comparison checks both ends of the range
+        standard = (characters[:, TIMESTAMP_WIDTH] == 0) & (
+            (characters[:, DIGIT_POSITIONS] - 48) <= 9).all(axis=1)
+        digits = characters[:, DIGIT_POSITIONS].astype(np.int32) - 48
+        start_ms = (digits @ np.array([START_WEIGHTS[position] for position in DIGIT_POSITIONS],
+                                      dtype=np.int32)).astype(np.int64)
+        end_ms = (digits @ np.array([END_WEIGHTS[position] for position in DIGIT_POSITIONS],
+                                    dtype=np.int32)).astype(np.int64)
+        others = np.flatnonzero(~standard)
+    else:
+        others = range(count)
+
+    for position in others:
+        parsed = parse_timestamp_line(timestamps[position]) or (0, 0)
+        start_ms[position], end_ms[position] = parsed
+    return start_ms, end_ms
+
+
+def text_stats(texts):
+    # Return (characters, lines, longest_line) arrays for the texts, computed over all of their characters at
+    # once. Characters do not count the line breaks.
+    load_numpy()
+    count = len(texts)
+    joined = '\x00'.join(texts) + '\x00'
+    data = np.frombuffer(joined.encode('utf-8'), dtype=np.uint8)
+
+    # Position of every line end, which is a line break or the end of a text; these bytes never occur
+    # inside a multi-byte character
+    breaks = np.flatnonzero((data == 0) | (data == 10))
+    if len(data) == len(joined):
+        # Plain ASCII: one byte per character
+        break_positions = breaks
+    else:
+        # Count characters instead of bytes by leaving out the continuation bytes of multi-byte characters
+        continuation = np.flatnonzero((data & 0xC0) == 0x80)
+        break_positions = breaks - np.searchsorted(continuation, breaks)
+    line_lengths = np.diff(np.concatenate(([-1], break_positions))) - 1
+
+    # The last line of every text is the one that ends with its terminator
+    last_line = np.flatnonzero(data[breaks] == 0)
+    lines = np.diff(np.concatenate(([-1], last_line)))
+    if count == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+    longest_line = np.maximum.reduceat(line_lengths, last_line - lines + 1)
+    characters = np.add.reduceat(line_lengths, last_line - lines + 1)
+    return characters, lines, longest_line
+
+
+def check_translations(indices, timestamps, sources, translations, limits=None):
+    # Check a finished subtitle track in one vectorized pass. The arguments are parallel lists with one entry
+    # per translated subtitle. Returns a dict with the indices flagged for every issue, the indices to translate
+    # again and the time the checks took.
+    load_numpy()
+    limits = dict(DEFAULT_LIMITS, **(limits or {}))
+    start_time = time.perf_counter()
+    indices = np.asarray(indices, dtype=np.int64)
+    if None in sources:
+        sources = [text or '' for text in sources]
+    if None in translations:
+        translations = [text or '' for text in translations]
+
+    start_ms, end_ms = parse_timings(timestamps)
+    source_chars, source_lines, source_longest = text_stats(sources)
+    chars, lines, longest = text_stats(translations)
+
+    # Reading speed over the display time; a cue without display time counts as shown for a millisecond
+    seconds = np.maximum(end_ms - start_ms, 1) / 1000.0
+    cps = chars / seconds
+    source_cps = source_chars / seconds
+    ratio = chars / np.maximum(source_chars, 1)
+
+    # A subtitle overlaps when the next one starts before it ends; the last one has no next subtitle
+    overlap = np.zeros(len(indices), dtype=bool)
+    overlap[:-1] = start_ms[1:] < end_ms[:-1]
+
+    # Only texts of the same length can be the same, so just those few are compared as strings
+    untranslated = np.zeros(len(indices), dtype=bool)
+    candidates = np.flatnonzero((chars == source_chars) & (chars >= limits['min_untranslated_chars'])).tolist()
+    untranslated[candidates] = [sources[position] == translations[position] for position in candidates]
+
+    flags = {
+        'empty': chars == 0,
+        'untranslated': untranslated,
+        'length_ratio': (source_chars >= limits['min_ratio_chars']) & (chars > 0)
+                        & ((ratio < limits['min_ratio']) | (ratio > limits['max_ratio'])),
+        'too_many_lines': lines > np.maximum(limits['max_lines'], source_lines),
+        # Long lines and fast subtitles are only the translation's fault if the source was within the limit
+        'long_line': (longest > limits['max_line_length']) & (source_longest <= limits['max_line_length']),
+        'reading_speed': (cps > limits['max_cps']) & (source_cps <= limits['max_cps']),
+        # Overlapping timings come from the source file, so they are reported but not translated again
+        'overlap': overlap,
+    }
+    requeue = np.zeros(len(indices), dtype=bool)
+    for issue in REQUEUE_ISSUES:
+        requeue |= flags[issue]
+    judged = (source_chars >= limits['min_ratio_chars']) & (chars > 0)
+    if judged.any():
+        wordy = ratio > np.median(ratio[judged]) * limits['outlier_factor']
+        for issue in WORDY_ISSUES:
+            requeue |= flags[issue] & wordy
+
+    return {
+        'cues': len(indices),
+        'issues': {issue: indices[flag].tolist() for issue, flag in flags.items()},
+        'requeue': indices[requeue].tolist(),
+        'mean_cps': float(cps.mean()) if len(indices) else 0.0,
+        'elapsed_ms': (time.perf_counter() - start_time) * 1000,
+    }
+
+
+def report(result, target_lang):
+    # Summarize a QA result in one line
+    issues = ', '.join(f"{len(flagged)} {issue.replace('_', ' ')}"
+                       for issue, flagged in result['issues'].items() if flagged)
+    return (f"QA ({target_lang}): {result['cues']} subtitles checked in {result['elapsed_ms']:.1f} ms, "
+            f"mean {result['mean_cps']:.1f} characters per second; "
+            f"{issues or 'no issues'}; {len(result['requeue'])} to translate again.")
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import time
+from db_func import SharedConnection
+from fuzzy_memory import band_keys, pack_keys
+from srt_parser import normalize_text
+
+
+def default_cache_path():
+    # The cache is shared by every movie, so it lives outside the movie folders by default
+    return os.getenv('TRANSLATION_CACHE_PATH') or os.path.join(
+        os.path.expanduser("~"), ".srt_subtitle_translator", "translation_cache.db")
+
+
+class TranslationCache:
+    def __init__(self, cache_path=None, max_entries=None):
+        # Create the folder for the cache database if needed
+        self.cache_path = cache_path or default_cache_path()
+        cache_folder = os.path.dirname(self.cache_path)
+        if cache_folder and not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+
+        # The least recently used entries are evicted once the cache grows past max_entries
+        self.max_entries = max_entries or int(os.getenv('TRANSLATION_CACHE_MAX_ENTRIES', 200000))
+        self.connection = SharedConnection(self.cache_path)
+        # Estimate of the number of entries, so the table is only counted again when it may be over the limit;
+        # None until the first write counts it
+        self.entry_count = None
+
+        # Statistics for the current run
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+
+        self.create_table()
+
+    def create_table(self):
+        # Create the cache table and the index used for eviction if they don't exist
+        try:
+            with self.connection as conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS translation_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        source_text TEXT,
+                        target_lang TEXT,
+                        service TEXT,
+                        model TEXT,
+                        translated_text TEXT,
+                        last_used REAL,
+                        hit_count INTEGER DEFAULT 0,
+                        lsh_keys BLOB
+                    );
+                ''')
+                # Caches from before the fuzzy translation memory get the column; the keys are filled in
+                # when the fuzzy index is next built
+                columns = [row[1] for row in conn.execute('PRAGMA table_info(translation_cache)')]
+                if 'lsh_keys' not in columns:
+                    conn.execute('ALTER TABLE translation_cache ADD COLUMN lsh_keys BLOB')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_translation_cache_last_used '
+                             'ON translation_cache (last_used)')
+        except Exception as e:
+            print(f"Error creating translation cache table: {e}")
+
+    def make_key(self, text, target_lang, service, model):
+        # Identify an entry by its normalized source text, target language, service and model
+        key_source = '\x1f'.join((normalize_text(text), (target_lang or '').lower(), service or '', model or ''))
+        return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts, target_lang, service, model, chunk_size=500):
+        # Return a list with the cached translation for each text, or None where there is no entry
+        keys = [self.make_key(text, target_lang, service, model) for text in texts]
+        results = [None] * len(keys)
+        try:
+            with self.connection as conn:
+                # Look the keys up in chunks with one query each, staying below SQLite's limit on parameters
+                found_by_key = {}
+                for start in range(0, len(keys), chunk_size):
+                    chunk = keys[start:start + chunk_size]
+                    found_by_key.update(conn.execute(
+                        f'SELECT cache_key, translated_text FROM translation_cache '
+                        f'WHERE cache_key IN ({", ".join("?" * len(chunk))})', chunk).fetchall())
+                results = [found_by_key.get(key) for key in keys]
+
+                # Mark the entries that were found as recently used
+                now = time.time()
+                with conn:
+                    conn.executemany('''
+                        UPDATE translation_cache
+                        SET last_used = ?, hit_count = hit_count + 1
+                        WHERE cache_key = ?;
+                    ''', [(now, key) for key, result in zip(keys, results) if result is not None])
+        except Exception as e:
+            print(f"Error reading the translation cache: {e}")
+
+        # Update the statistics for the run
+        found = sum(1 for result in results if result is not None)
+        self.hits += found
+        self.misses += len(results) - found
+        return results
+
+    def put_many(self, entries, target_lang, service, model):
+        # Store (source_text, translated_text) pairs in the cache and evict the oldest entries if needed
+        now = time.time()
+        try:
+            with self.connection as conn:
+                with conn:
+                    conn.executemany('''
+                        INSERT OR REPLACE INTO translation_cache
+                            (cache_key, source_text, target_lang, service, model, translated_text, last_used,
+                             lsh_keys)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                    ''', [(self.make_key(source_text, target_lang, service, model), normalize_text(source_text),
+                           target_lang, service, model, translated_text, now, pack_keys(band_keys(source_text)))
+                          for source_text, translated_text in entries])
+                    self.evict(conn, len(entries))
+        except Exception as e:
+            print(f"Error writing to the translation cache: {e}")
+
+    def evict(self, conn, added):
+        # Delete the least recently used entries once the cache grows past max_entries, down to a tenth below it,
+        # so a full cache is not counted and trimmed again on every write.
+        # The count is kept up to date from the rows added instead of counting the table each time;
+        # replaced rows and other processes make it drift, so the table is counted again before evicting.
+        if self.entry_count is not None:
+            self.entry_count += added
+            if self.entry_count <= self.max_entries:
+                return
+        count = conn.execute('SELECT COUNT(*) FROM translation_cache').fetchone()[0]
+        if count > self.max_entries:
+            keep = self.max_entries - self.max_entries // 10
+            conn.execute('''
+                DELETE FROM translation_cache WHERE cache_key IN (
+                    SELECT cache_key FROM translation_cache ORDER BY last_used LIMIT ?
+                );
+            ''', (count - keep,))
+            count = keep
+        self.entry_count = count
+
+    def report(self):
+        # Summarize how many subtitles were served without an API call during the run
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return "Translation cache: no lookups."
+        hit_rate = self.hits / lookups * 100
+        return (f"Translation cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+                f"{self.duplicates} duplicates collapsed, "
+                f"{self.hits + self.duplicates} subtitles translated without an API call.")
+
+    def close(self):
+        # Close the cache database connection
+        self.connection.close()
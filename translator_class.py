@@ -1,9 +1,25 @@
 from dotenv import load_dotenv
+import glob
+import json
 import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from db_func import DatabaseManager
+from translation_cache import TranslationCache, normalize_text
+from fuzzy_memory import FuzzyMemory
+from srt_parser import iter_srt_cues, clean_html_tags, file_hash
+from batch_builder import BatchBuilder
+from batch_protocol import encode_batch, decode_batch, encode_rows, decode_reply
+from batch_retry import translate_with_retries
+from metrics import MetricsRecorder, timed_iter
+from context_window import ContextWindow
+from scene_scheduler import split_scenes, timings_from_timestamps, SceneIndex, SceneScheduler
+import subtitle_qa
 import re
-from openai_translator import translate_openai
-from deepl_translator import translate_deepl
+from providers import get_provider, provider_names, menu_providers
 from colorama import Fore, Style, init
 
 # Automatically reset styling after each print statement
@@ -12,48 +28,17 @@ init(autoreset=True)
 # Load environment variables from .env file
 load_dotenv()
 
-# A list to keep track of indices of translations that failed
-failed_translations = []
-
-
-def read_srt(file_path):
-    try:
-        # Open the SRT file with the specified encoding
-        with open(file_path, 'r', encoding='ISO-8859-1') as file:
-            return file.read()
-    except FileNotFoundError:
-        # Print an error message if the file is not found
-        print("File not found:", file_path)
-        return None
-
-
-def is_translation_valid(original, translated):
-    # Split the original and translated text by double newlines to get blocks
-    original_blocks = original.split('\n\n')
-    translated_blocks = translated.split('\n\n')
-
-    # Check if the number of blocks in both texts are equal
-    if len(original_blocks) != len(translated_blocks):
-        return False
-
-    # Ensure that each translated block has no more than two newlines
-    for trans_block in translated_blocks:
-        trans_line_count = trans_block.count('\n')
-        if trans_line_count > 2:
-            return False
-
-    # Return True if the translation is considered valid
-    return True
-
-
-def clean_html_tags(text):
-    # Use regular expressions to remove HTML tags from the text
-    clean_text = re.sub(r'<[^>]+>', '', text)
-    return clean_text
+# Databases from before per-language storage hold translations into this language unless an exported file says
+# otherwise, as the translator used to translate only into Finnish
+LEGACY_TARGET_LANG = "fi"
 
 
 class Translator:
-    def __init__(self, file_path, target_lang=None, index_range=None, batch_size=5, overwrite_translations=False):
+    def __init__(self, file_path, target_lang=None, index_range=None, batch_size=20, overwrite_translations=False,
+                 concurrency=4, use_cache=True, cache_path=None, target_langs=None, char_budget=1500,
+                 adaptive_batching=True, bisect_failures=True, batch_format='tagged', metrics=None,
+                 context_size=3, context_char_budget=600, context_lookahead=0, lease_seconds=900,
+                 scene_gap=3.0, scene_max_cues=100, fuzzy_threshold=0.7, qa=True, qa_limits=None):
 
         # Get the folder path and base name of the file
         folder_path = os.path.dirname(file_path)
@@ -77,21 +62,90 @@ class Translator:
         self.translations_path = translation_folder
         self.movie_name = base_name
 
+        # Per-stage timings and counters; enabled with metrics=True or the SRT_METRICS environment variable
+        if metrics is None:
+            metrics = os.getenv('SRT_METRICS', '').lower() in ('1', 'true', 'yes')
+        self.metrics = MetricsRecorder(enabled=metrics, labels={'movie': base_name})
+
         # Initialize the rest of the variables
         self.file_path = file_path
-        self.target_lang = target_lang
+        # Every run translates into all of target_langs; target_lang is the first of them
+        self.target_langs = list(target_langs) if target_langs else [target_lang]
+        self.target_lang = self.target_langs[0]
         self.overwrite_translations = overwrite_translations
         self.index_range = index_range
         self.batch_size = batch_size
         self.translation_service = None
-
-        # Create a database manager instance
-        self.database_manager = DatabaseManager(self.db_path, self.overwrite_translations, self.file_path)
+        # Maximum number of batches that are being translated at the same time
+        self.concurrency = max(1, concurrency)
+        # Subtitles are leased to this translator while their batch is being translated; a lease that is
+        # not finished within lease_seconds, for example after a crash, can be claimed by another worker
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        # Packs rows into requests by a character budget, with batch_size as the maximum number of rows
+        self.batch_builder = BatchBuilder(char_budget, adaptive=adaptive_batching)
+        # Built on first use for services that take a list of subtitles and return one translation per item
+        self.list_batch_builder = None
+
+        # 'tagged' sends every subtitle under an [index] marker and accepts the reply cue by cue;
+        # 'plain' joins the texts with blank lines and accepts the reply only as a whole
+        # Services that translate lists, such as DeepL, get the subtitles of a 'tagged' batch as a list instead
+        self.batch_format = batch_format
+
+        # Glossary id for each language, looked up once per run
+        self.glossaries = {}
+        self.glossaries_lock = threading.Lock()
+
+        # Split failing batches in halves to find the rows that break them, instead of resending the whole batch
+        self.bisect_failures = bisect_failures
+        # Requests made for batches that needed retries, and the estimate for resending them whole
+        self.retry_stats = {'retried_batches': 0, 'calls': 0, 'resend_calls': 0}
+        self.retry_stats_lock = threading.Lock()
+
+        # Instructions for each language, built once so every request starts with the same prefix
+        self.system_prompts = {}
+
+        # Translations finished during this run, used as context without asking the database for every request
+        self.context_window = ContextWindow(context_size, context_char_budget, context_lookahead)
+
+        # Scenes are cut where the subtitles pause for at least scene_gap seconds; batches stay within a scene,
+        # context only flows within a scene, and different scenes are translated in parallel.
+        # A scene_gap of 0 turns scenes off. The scenes are worked out from the stored timestamps on first use.
+        self.scene_gap = scene_gap
+        self.scene_max_cues = scene_max_cues
+        self.scenes = None
+
+        # Check the finished track for reading speed, line length and missing translations, and translate
+        # the outliers once more before the SRT file is written; needs NumPy. qa_limits overrides
+        # subtitle_qa.DEFAULT_LIMITS.
+        self.qa = qa
+        self.qa_limits = qa_limits
+
+        # Translation memory shared by all movies, consulted before anything is sent to a translation service
+        self.translation_cache = TranslationCache(cache_path) if use_cache else None
+        # Near-identical cached subtitles with a trigram similarity of at least fuzzy_threshold are reused when
+        # they differ only in punctuation or case, and otherwise sent to OpenAI as examples; 0 turns this off
+        self.fuzzy_memory = None
+        if self.translation_cache is not None and fuzzy_threshold:
+            self.fuzzy_memory = FuzzyMemory(self.translation_cache, fuzzy_threshold)
+        # Similar earlier translations for the rows to send: (target_lang, subtitle_index) -> [(source, translation)];
+        # cleared once the rows of a range or a batch job have been sent
+        self.fuzzy_examples = {}
+
+        # Create a database manager instance that keeps one connection open for the life of the translator
+        self.database_manager = DatabaseManager(self.db_path, self.overwrite_translations, self.file_path,
+                                                reuse_connection=True, target_lang=self.target_lang)
 
         # Check if the translations table exists, create it if not, and read/store the SRT file
-        if not self.database_manager.check_if_table_exists():
-            self.database_manager.create_table()
+        # The source subtitles are stored once and shared by every target language
+        table_exists = self.database_manager.check_if_table_exists()
+        self.database_manager.create_table()
+        if not table_exists:
             self.read_and_store_srt(file_path)
+        else:
+            self.database_manager.migrate_legacy_translations(self.get_legacy_language())
+            # Pick up a re-released or corrected source file without starting over
+            self.sync_source(file_path)
 
         # Set the default index range if not specified
         if index_range is None:
@@ -100,78 +154,239 @@ class Translator:
         else:
             self.index_range = index_range
 
+    def export_metrics(self, json_path=None, prometheus_path=None):
+        # Write the run's timings and counters as a JSON report and/or a Prometheus textfile
+        if not self.metrics.enabled:
+            return
+        if json_path:
+            self.metrics.write_json(json_path)
+            print(f"Run report saved to file: {json_path}")
+        if prometheus_path:
+            self.metrics.write_prometheus(prometheus_path)
+            print(f"Prometheus metrics saved to file: {prometheus_path}")
+
+    def get_legacy_language(self):
+        # The language of the translations in a database from before per-language storage: the language of the
+        # most recently exported "Movie.<lang>.srt" file, or Finnish, which the translator always used back then
+        exported = glob.glob(os.path.join(glob.escape(self.translations_path), glob.escape(self.movie_name) + ".*.srt"))
+        languages = [(os.path.getmtime(path), os.path.basename(path)[len(self.movie_name) + 1:-len(".srt")])
+                     for path in exported]
+        languages = [(modified, lang) for modified, lang in languages if lang and '.' not in lang]
+        return max(languages)[1] if languages else LEGACY_TARGET_LANG
+
+    def close(self):
+        # Close the database connections held by the translator
+        self.database_manager.close()
+        if self.fuzzy_memory is not None:
+            self.fuzzy_memory.close()
+        if self.translation_cache is not None:
+            self.translation_cache.close()
+
     def read_and_store_srt(self, file_path):
         # Check if the database already has data for this file to avoid re-reading
         if self.database_manager.check_if_data_exists():
             print("The database already has information on this file. Reading will not be performed again.")
             return
 
-        # Read the content of the SRT file
-        srt_content = read_srt(file_path)
-        # If the file couldn't be read, return without doing anything
-        if srt_content is None:
+        # Make sure the file can be read before streaming it
+        if not os.path.exists(file_path):
+            print("File not found:", file_path)
             return
 
-        # Split the content into subtitle blocks and process each one
-        for line in srt_content.split('\n\n'):
-            # Make sure the line is not just whitespace
-            if line.strip():
-                parts = line.split('\n')
-                subtitle_index = parts[0]  # The first line is the subtitle index
-                timestamp = parts[1]  # The second line is the subtitle timestamp
-                original_text = '\n'.join(parts[2:])  # The rest is the subtitle text
-                # Clean the text of any HTML tags
-                cleaned_text = clean_html_tags(original_text)
+        # Stream the cues from the file, cleaning the text of any HTML tags on the way
+        start_time = time.perf_counter()
+        # The parse stage is the time spent inside the parser; ingest is the whole load including it
+        cues = timed_iter(iter_srt_cues(file_path), self.metrics, 'parse')
+        rows = ((cue.index, cue.timestamp, clean_html_tags(cue.text)) for cue in cues)
+
+        # Save all the subtitles into the database in one transaction
+        stored_count = self.database_manager.save_many_to_db(rows)
+        elapsed = time.perf_counter() - start_time
+        self.metrics.observe('ingest', elapsed)
+        self.metrics.increment('cues_ingested', stored_count)
+
+        # Report the ingest throughput
+        rate = stored_count / elapsed if elapsed > 0 else 0
+        print(f"Stored {stored_count} subtitles in {elapsed * 1000:.1f} ms ({rate:.0f} subtitles/s).")
+
+        # Remember which file the subtitles came from, so a changed file can be noticed
+        self.database_manager.save_source_hash(file_hash(file_path))
+
+    def sync_source(self, file_path):
+        # Compare the source file with the one the subtitles were read from, and if it has changed,
+        # update the stored subtitles so only new and edited cues have to be translated again
+        if not os.path.exists(file_path):
+            return
+        source_hash = file_hash(file_path)
+        stored_hash = self.database_manager.get_source_hash()
+        if source_hash == stored_hash:
+            return
+        if stored_hash is None:
+            # Databases from before source tracking may hold text decoded differently, e.g. as ISO-8859-1, so
+            # comparing their cues would throw away translations of unchanged cues; the file they were read
+            # from is taken as the current one instead
+            self.database_manager.save_source_hash(source_hash)
+            return
 
-                # Save the cleaned text into the database
-                self.database_manager.save_to_db(subtitle_index, timestamp, cleaned_text)
+        start_time = time.perf_counter()
+        cues = timed_iter(iter_srt_cues(file_path), self.metrics, 'parse')
+        stats = self.database_manager.resync_source(
+            (cue.index, cue.timestamp, clean_html_tags(cue.text)) for cue in cues)
+        if stats is None:
+            return
+        self.database_manager.save_source_hash(source_hash)
+        self.metrics.observe('ingest', time.perf_counter() - start_time)
+
+        changed = stats['retimed'] + stats['edited'] + stats['added'] + stats['removed']
+        if changed:
+            print(f"The source file has changed: {stats['unchanged']} subtitles unchanged, {stats['retimed']} moved "
+                  f"or retimed, {stats['edited']} edited, {stats['added']} added and {stats['removed']} removed. "
+                  f"Only the edited and added subtitles will be translated again.")
 
     def select_translation_service(self):
-        # Prompt the user to select between OpenAI and DeepL translation services
+        # Prompt the user to select one of the registered translation services
+        choices = menu_providers()
         print("Select the translation service:")
-        print("1. OpenAI")
-        print("2. DeepL")
-        choice = input("Enter your choice (1/2): ")
+        for number, (name, label) in enumerate(choices, start=1):
+            print(f"{number}. {label}")
+        choice = input(f"Enter your choice (1-{len(choices)}): ")
 
         # Set the translation service based on user input
-        if choice == '1':
-            self.translation_service = 'openai'
-        elif choice == '2':
-            self.translation_service = 'deepl'
+        if choice.isdigit() and 1 <= int(choice) <= len(choices):
+            self.translation_service = choices[int(choice) - 1][0]
         else:
             # Default to DeepL if the choice is invalid
             print("Invalid choice. Defaulting to DeepL.")
             self.translation_service = 'deepl'
 
-    def translate_with_openai(self, original_text, subtitle_index):
-        # Fetch context from the database for a better translation result
-        # Context is the previous translation which can help in maintaining consistency
-        context = self.database_manager.get_translation_from_index(subtitle_index - 1)
-
-        # Call the OpenAI translation function from the 'openai_translator.py' file
+    def get_provider(self):
+        # The module of the selected translation service, imported on first use
+        return get_provider(self.translation_service)
+
+    def get_system_prompt(self, target_lang, tagged):
+        # Return the instructions for the language, building them on first use
+        key = (target_lang, tagged)
+        if key not in self.system_prompts:
+            self.system_prompts[key] = self.get_provider().build_system_prompt(target_lang, self.movie_name, tagged)
+        return self.system_prompts[key]
+
+    def get_scenes(self):
+        # Return the SceneIndex of the film, or None when scenes are turned off
+        if not self.scene_gap:
+            return None
+        if self.scenes is None:
+            timings = timings_from_timestamps(self.database_manager.get_timestamps())
+            self.scenes = SceneIndex(split_scenes(timings, int(self.scene_gap * 1000), self.scene_max_cues))
+        return self.scenes
+
+    def scene_bounds(self, subtitle_index):
+        # Return the (first_index, last_index) of the scene holding subtitle_index, or (None, None)
+        scenes = self.get_scenes()
+        return scenes.bounds(subtitle_index) if scenes is not None else (None, None)
+
+    def get_context(self, subtitle_index, target_lang):
+        # Return the translations just before subtitle_index from the in-memory context window,
+        # without reaching back into the previous scene
+        with self.metrics.stage('context_lookup'):
+            return self.context_window.previous(target_lang, subtitle_index, self.scene_bounds(subtitle_index)[0])
+
+    def translate_with_context(self, original_text, subtitle_index, target_lang=None, tagged=False, next_index=None,
+                               examples=None):
+        target_lang = target_lang or self.target_lang
+        # Fetch context for a better translation result
+        # Context is the previous translations which can help in maintaining consistency,
+        # optionally followed by the source subtitles that come after the batch
+        context = self.get_context(subtitle_index, target_lang)
+        upcoming = ''
+        if next_index is not None:
+            # The lookahead ends with the scene of the batch
+            upcoming = self.context_window.upcoming(next_index, self.scene_bounds(next_index - 1)[1])
+
+        # Call the translation function of the selected service
         # It uses the original text, the target language, the movie name, and the context
-        translated_text = translate_openai(
-            original_text=original_text,
-            target_lang=self.target_lang,
+        translated_text = self.get_provider().translate(
+            original_text,
+            target_lang,
             movie_name=self.movie_name,
-            context=context
+            context=context,
+            tagged=tagged,
+            upcoming=upcoming,
+            system_prompt=self.get_system_prompt(target_lang, tagged),
+            examples=examples
         )
 
         # Return the translated text
         return translated_text
 
-    def translate_deepl(self, original_text):
-        # Use the translate_deepl function from the deepl_translator module
-        # The function takes the original text and the target language to perform the translation
-        # The target language is a class attribute defined in the Translator class
-        translated_text = translate_deepl(original_text, self.target_lang)
+    def get_model_name(self):
+        # Name of the model behind the selected service, used to keep cached translations apart
+        provider = self.get_provider()
+        return provider.model_name() if hasattr(provider, 'model_name') else ''
+
+    def translate_text(self, original_text, target_lang=None):
+        # Translate without context with the selected service
+        # The target language defaults to the first target language of the Translator
+        translated_text = self.get_provider().translate(original_text, target_lang or self.target_lang)
 
         # Return the text translated into the target language
         return translated_text
 
+    def uses_list_batches(self):
+        # Services that translate lists get tagged batches as a list of subtitles
+        return self.batch_format == 'tagged' and hasattr(self.get_provider(), 'translate_list')
+
+    def get_batch_builder(self):
+        # The batch builder for the selected service
+        if not self.uses_list_batches():
+            return self.batch_builder
+        if self.list_batch_builder is None:
+            # List batches are only limited by the request size; the budget is not tuned
+            # because lists do not break like model replies
+            limit = self.get_provider().MAX_LIST_CHARS
+            self.list_batch_builder = BatchBuilder(limit, max_budget=limit, adaptive=False)
+        return self.list_batch_builder
+
+    def get_max_batch_cues(self, batch_size):
+        # Lists are sent as large as a request allows; other batches use the batch size
+        return self.get_provider().MAX_LIST_TEXTS if self.uses_list_batches() else batch_size
+
+    def get_glossary(self, target_lang):
+        # Return the id of the service's glossary for the language, or None if the movie has no glossary file
+        # or the service has no glossaries.
+        # The file sits next to the SRT file, e.g. "Movie.glossary.fi.tsv" with "source<TAB>translation" lines.
+        # The glossary is created once and reused until the file changes.
+        provider = self.get_provider()
+        if not hasattr(provider, 'ensure_glossary'):
+            return None
+        with self.glossaries_lock:
+            if target_lang in self.glossaries:
+                return self.glossaries[target_lang]
+
+            glossary_id = None
+            glossary_path = os.path.join(os.path.dirname(self.file_path),
+                                         f"{self.movie_name}.glossary.{target_lang}.tsv")
+            if os.path.exists(glossary_path):
+                entries = provider.read_glossary_entries(glossary_path)
+                entries_hash = provider.glossary_hash(target_lang, entries)
+                stored = self.database_manager.get_glossary(target_lang)
+                if stored and stored[1] == entries_hash:
+                    glossary_id = provider.ensure_glossary(self.movie_name, target_lang, entries, stored[0])
+                elif entries:
+                    # The file has changed, so the old glossary is replaced
+                    if stored and stored[0]:
+                        provider.delete_glossary(stored[0])
+                    glossary_id = provider.ensure_glossary(self.movie_name, target_lang, entries)
+                if glossary_id and (not stored or stored[0] != glossary_id):
+                    self.database_manager.save_glossary(glossary_id, entries_hash, target_lang)
+                    print(f"Using a glossary with {len(entries)} entries for '{target_lang}'.")
+
+            self.glossaries[target_lang] = glossary_id
+            return glossary_id
+
     def calculate_default_index_range(self):
-        # Retrieve the index of the last subtitle that was translated
-        start_index = self.database_manager.get_last_translated_index()
+        # Retrieve the index of the first subtitle still missing a translation in any target language
+        start_index = min(self.database_manager.get_last_translated_index(target_lang)
+                          for target_lang in self.target_langs)
         # Get the highest subtitle index in the database to define the range
         max_index = self.database_manager.get_max_subtitle_index()
 
@@ -186,8 +401,10 @@ class Translator:
         return start_index, end_index
 
     def create_translated_srt(self):
-        # Suorita tallennustoiminto suoraan DatabaseManager-olion kautta
-        self.database_manager.save_translations_to_srt(self.target_lang, self.movie_name, self.translations_path)
+        # Write one translated SRT file for each target language through the DatabaseManager
+        for target_lang in self.target_langs:
+            with self.metrics.stage('srt_write'):
+                self.database_manager.save_translations_to_srt(target_lang, self.movie_name, self.translations_path)
 
     def get_user_input(self, default_index_range):
 
@@ -199,10 +416,10 @@ class Translator:
             index_range = index_range_input if index_range_input else default_index_range
             print(f"Setting index_range to {index_range}\n")
 
-            # Ask for the batch size, which determines how many translations are processed at once
-            batch_size_input = input("Enter the batch size (default 5): ").strip()
+            # Ask for the batch size, the most subtitles sent in one request; requests are also limited by length
+            batch_size_input = input("Enter the maximum batch size (default 20): ").strip()
             # Ensure the batch size is a digit and fallback to default if not
-            batch_size = int(batch_size_input) if batch_size_input.isdigit() else 5
+            batch_size = int(batch_size_input) if batch_size_input.isdigit() else 20
             print(f"Setting batch_size to {batch_size}\n")
 
             # Query whether previously translated texts should be overwritten
@@ -307,85 +524,356 @@ class Translator:
         self.batch_size = batch_size
         self.overwrite_translations = overwrite_translations
 
-    def process_and_translate_range(self, start_index, end_index, batch_size, overwrite_translations):
-        # Initialize the current index to the start of the range
-        current_index = start_index
-        # Set a commit interval to update the database in batches
-        commit_interval = 50
-        # Keep track of the number of translations processed
-        translations_count = 0
-        # Initialize a list to store translation updates
-        translations_to_update = []
-        # Access the global list of failed translations
-        global failed_translations
-
-        # Process subtitles in the specified range in batches
-        while current_index <= end_index:
-            # Determine the last index of the current batch
-            next_batch_index = min(current_index + batch_size - 1, end_index)
-            print(f"Translating lines {current_index}-{next_batch_index}...")
-
-            # Fetch rows to translate from the database
-            rows_to_translate = self.database_manager.fetch_rows_to_translate(current_index, next_batch_index,
-                                                                              overwrite_translations)
-            # Concatenate the text of the rows to form the batch text
-            batch_text = '\n\n'.join([row[1] for row in rows_to_translate])
-
-            # Initialize variables for translation attempts
-            translated_text = None
-            attempts = 0
-            max_attempts = 5
-            # Try translating the batch text until successful or max attempts are reached
-            while attempts < max_attempts:
-                # Use the specified translation service to translate the text
-                if self.translation_service == 'openai':
-                    translated_text = self.translate_with_openai(batch_text, current_index)
-                elif self.translation_service == 'deepl':
-                    translated_text = self.translate_deepl(batch_text)
+    def request_translation(self, rows_to_translate, target_lang, attempt):
+        # Send the rows to the translation service once and return (results, missing_rows, replied):
+        # the (subtitle_index, text) pairs that were accepted, the rows that have to be sent again and
+        # whether the service replied at all, as opposed to returning an error
+        # Services that translate lists get every subtitle as a separate item, so the reply is accepted cue by cue
+        list_mode = self.uses_list_batches()
+        batch_format = 'list' if list_mode else self.batch_format
+        batch_text = encode_rows(rows_to_translate, batch_format)
+        first_index = rows_to_translate[0][0]
+        last_index = rows_to_translate[-1][0]
+
+        # Use the specified translation service to translate the text
+        start_time = time.perf_counter()
+        with self.metrics.stage('provider_call'):
+            if list_mode:
+                translated_text = self.get_provider().translate_list(batch_text, target_lang,
+                                                                     self.get_glossary(target_lang))
+            elif getattr(self.get_provider(), 'USES_CONTEXT', False):
+                translated_text = self.translate_with_context(batch_text, first_index, target_lang,
+                                                              batch_format == 'tagged', last_index + 1,
+                                                              self.get_examples(rows_to_translate, target_lang))
+            else:
+                translated_text = self.translate_text(batch_text, target_lang)
+        self.metrics.increment('api_calls')
+
+        # Check which translations are valid
+        with self.metrics.stage('validation'):
+            results, missing_rows = decode_reply(translated_text, rows_to_translate, batch_format)
+        if missing_rows:
+            self.metrics.increment('validation_failures')
+
+        # Let the batch builder learn from the result, but only when the model actually answered:
+        # a provider error says nothing about whether the batch was too big to translate
+        replied = translated_text is not None
+        if replied:
+            self.get_batch_builder().record(time.perf_counter() - start_time, not missing_rows)
+        if not results:
+            print(
+                f"Translation attempt {attempt} " + Fore.RED + "failed" + Style.RESET_ALL + f" for lines {first_index}-{last_index} ({target_lang}).")
+            return results, missing_rows, replied
+
+        if missing_rows:
+            print(
+                f"Translation attempt {attempt} " + Fore.YELLOW + "partly succeeded" + Style.RESET_ALL + f" for lines {first_index}-{last_index} ({target_lang}), {len(missing_rows)} lines missing.")
+        else:
+            print(
+                f"Translation attempt {attempt} " + Fore.GREEN + "succeeded" + Style.RESET_ALL + f" for lines {first_index}-{last_index} ({target_lang}).")
+
+        # Make the translations available as context for the batches that follow
+        self.context_window.add(target_lang, results)
+        return results, missing_rows, replied
+
+    def translate_rows(self, rows_to_translate, target_lang, calls, first_missing=None):
+        # Translate the rows and return (results, failed_rows); calls[0] counts the requests made and
+        # first_missing, if given, gets the number of rows missing from the first reply
+        def request(rows, attempt):
+            results, missing_rows, replied = self.request_translation(rows, target_lang, attempt)
+            if first_missing is not None and not first_missing:
+                first_missing.append(len(missing_rows) if replied else len(rows))
+            return results, missing_rows, replied
+
+        return translate_with_retries(request, rows_to_translate, bisect=self.bisect_failures, calls=calls,
+                                      label=f" ({target_lang})")
+
+    def estimate_resend_calls(self, batch_size, first_missing):
+        # Estimate the requests that resending whole batches would have taken for a batch whose first reply
+        # missed first_missing of its batch_size rows: the batch is sent up to four more times until a reply
+        # has every row, which happens as often as it would with rows failing at the rate of the first reply,
+        # and if no reply does, every row is sent on its own in the retry pass
+        valid_chance = (1 - first_missing / batch_size) ** batch_size
+        calls = 1.0
+        still_failing = 1.0
+        for _ in range(4):
+            calls += still_failing
+            still_failing *= 1 - valid_chance
+        return calls + still_failing * batch_size
+
+    def translate_batch(self, rows_to_translate, overwrite_translations, target_lang=None):
+        # Translate one batch and return (results, failed_rows)
+        target_lang = target_lang or self.target_lang
+        if self.translation_service not in provider_names():
+            print("Error: Unknown translation service.")
+            return [], rows_to_translate
+
+        calls = [0]
+        first_missing = []
+        results, failed_rows = self.translate_rows(rows_to_translate, target_lang, calls, first_missing)
+
+        # Compare the cost with resending the whole batch
+        if calls[0] > 1:
+            resend_calls = self.estimate_resend_calls(len(rows_to_translate), first_missing[0])
+            with self.retry_stats_lock:
+                self.retry_stats['retried_batches'] += 1
+                self.retry_stats['calls'] += calls[0]
+                self.retry_stats['resend_calls'] += resend_calls
+        return results, failed_rows
+
+    def get_usage_stats(self):
+        # Token counts of the selected service, or None if it does not report them
+        provider = self.get_provider()
+        return provider.get_usage_stats() if hasattr(provider, 'get_usage_stats') else None
+
+    def prompt_cache_report(self, usage_before):
+        # Summarize how many prompt tokens of this run the provider served from its prompt cache
+        usage = self.get_usage_stats()
+        prompt_tokens = usage['prompt_tokens'] - usage_before['prompt_tokens']
+        cached_tokens = usage['cached_prompt_tokens'] - usage_before['cached_prompt_tokens']
+        self.metrics.increment('prompt_tokens', prompt_tokens)
+        self.metrics.increment('cached_prompt_tokens', cached_tokens)
+        self.metrics.increment('completion_tokens', usage['completion_tokens'] - usage_before['completion_tokens'])
+        share = cached_tokens / prompt_tokens * 100 if prompt_tokens else 0
+        return (f"Prompt tokens: {prompt_tokens}, of which {cached_tokens} cached ({share:.1f}%), "
+                f"{prompt_tokens - cached_tokens} uncached.")
+
+    def retry_report(self):
+        # Summarize the requests saved by splitting failing batches and resending only the missing rows
+        stats = self.retry_stats
+        return (f"Retries: {stats['retried_batches']} batches needed more than one request and used {stats['calls']}, "
+                f"about {stats['resend_calls']:.0f} with whole-batch resends "
+                f"({stats['resend_calls'] - stats['calls']:.0f} saved).")
+
+    def apply_translation_cache(self, rows, overwrite_translations, target_lang=None):
+        target_lang = target_lang or self.target_lang
+        # Look up each row in the translation cache, unless existing translations are being replaced on purpose
+        cached_translations = []
+        if self.translation_cache is not None and not overwrite_translations and rows:
+            cached = self.translation_cache.get_many([row[1] for row in rows], target_lang,
+                                                     self.translation_service, self.get_model_name())
+            remaining_rows = []
+            for row, translated_text in zip(rows, cached):
+                if translated_text is None:
+                    remaining_rows.append(row)
                 else:
-                    print("Error: Unknown translation service.")
-                    break
-                attempts += 1
-
-                # Check if the translation is valid
-                if translated_text and is_translation_valid(batch_text, translated_text):
-                    print(
-                        f"Translation attempt {attempts} " + Fore.GREEN + "succeeded" + Style.RESET_ALL + f" for lines {current_index}-{next_batch_index}.")
-                    # Split the translated text into blocks
-                    translated_blocks = translated_text.split('\n\n')
-
-                    # Update the database with the translations
-                    for i, block in enumerate(translated_blocks):
-                        subtitle_index = rows_to_translate[i][0]
-                        translations_to_update.append((subtitle_index, block))
-
-                    translations_count += len(rows_to_translate)
-                    # Update the database if the commit interval is reached or at the end of the range
-                    if translations_count >= commit_interval or next_batch_index == end_index:
-                        self.database_manager.update_database(translations_to_update, overwrite_translations)
-                        translations_to_update = []
-                        translations_count = 0
+                    cached_translations.append((row[0], translated_text))
+            rows = remaining_rows
+
+            # Subtitles that are close to a cached one are reused or get it as an example
+            if self.fuzzy_memory is not None and rows:
+                rows = self.apply_fuzzy_memory(rows, target_lang, cached_translations)
+
+            # Cached translations can be used as context like any other finished translation
+            self.context_window.add(target_lang, cached_translations)
+
+        # Send each distinct text only once; duplicates maps the index of the row that is sent
+        # to the indices of the rows that will get the same translation
+        first_index_by_text = {}
+        duplicates = {}
+        unique_rows = []
+        for row in rows:
+            key = normalize_text(row[1])
+            if key in first_index_by_text:
+                duplicates.setdefault(first_index_by_text[key], []).append(row[0])
+            else:
+                first_index_by_text[key] = row[0]
+                unique_rows.append(row)
+
+        if self.translation_cache is not None:
+            self.translation_cache.duplicates += len(rows) - len(unique_rows)
+
+        return unique_rows, cached_translations, duplicates
+
+    def apply_fuzzy_memory(self, rows, target_lang, cached_translations):
+        # Look up the rows in the fuzzy translation memory. Rows that differ from a cached subtitle only in
+        # punctuation, case or spacing take its translation and are added to cached_translations; the other
+        # rows with matches keep them as examples. Returns the rows that still have to be sent.
+        service, model = self.translation_service, self.get_model_name()
+        with self.metrics.stage('fuzzy_lookup'):
+            matches = self.fuzzy_memory.lookup_many([row[1] for row in rows], target_lang, service, model)
+        remaining_rows = []
+        for row, row_matches in zip(rows, matches):
+            reused = None
+            for match in row_matches:
+                reused = self.fuzzy_memory.reusable(row[1], match, service, model)
+                if reused is not None:
                     break
-                else:
-                    print(
-                        f"Translation attempt {attempts} " + Fore.RED + "failed" + Style.RESET_ALL + f" for lines {current_index}-{next_batch_index}.")
+            if reused is not None:
+                cached_translations.append((row[0], reused))
+                self.fuzzy_memory.reused += 1
+                continue
+            if row_matches:
+                self.fuzzy_examples[(target_lang, row[0])] = [(match[1], match[2]) for match in row_matches]
+                self.fuzzy_memory.examples += 1
+            remaining_rows.append(row)
+        self.metrics.increment('fuzzy_reused', len(rows) - len(remaining_rows))
+        return remaining_rows
+
+    def get_examples(self, rows, target_lang, limit=5):
+        # Return up to limit distinct (source, translation) examples for the rows of a batch
+        examples = []
+        for row in rows:
+            for example in self.fuzzy_examples.get((target_lang, row[0]), ()):
+                if example not in examples:
+                    examples.append(example)
+        return examples[:limit]
+
+    def process_and_translate_range(self, start_index, end_index, batch_size, overwrite_translations,
+                                    target_langs=None):
+        # Translate the range into every target language, sharing one pool of workers
+        target_langs = target_langs or self.target_langs
+
+        # Prepare the rows of every language before any of them is sent
+        rows_by_lang = {}
+        duplicates = {}
+        for target_lang in target_langs:
+            # Fetch the rows in the range that need translating into this language
+            with self.metrics.stage('row_fetch'):
+                rows = self.database_manager.fetch_rows_to_translate(start_index, end_index, overwrite_translations,
+                                                                     target_lang) or []
+
+            # Start the context window with the translations stored just before the range, in one query
+            with self.metrics.stage('context_lookup'):
+                self.context_window.add(target_lang, self.database_manager.get_translations_before(
+                    start_index, self.context_window.size, target_lang))
+            self.context_window.add_sources(rows)
+
+            # Fill in translations from the cache and collapse repeated texts, leaving the rows to send
+            rows, cached_translations, duplicates[target_lang] = self.apply_translation_cache(
+                rows, overwrite_translations, target_lang)
+            if cached_translations:
+                with self.metrics.stage('database_update'):
+                    self.database_manager.finish_batch(cached_translations, [], overwrite_translations, target_lang)
+            self.metrics.increment('cache_hits', len(cached_translations))
+
+            rows_by_lang[target_lang] = rows
 
-                # If all attempts fail, add the batch to the list of failed translations
-                if attempts == max_attempts:
-                    print(
-                        f"All translation attempts " + Fore.RED + "failed" + Style.RESET_ALL + f" for lines {current_index}-{next_batch_index}. Adding to the list of failures.")
-                    failed_translations.extend([row[0] for row in rows_to_translate])
-
-            # Move to the next batch
-            current_index = next_batch_index + 1
-
-        # Final update to the database with any remaining translations
-        if translations_to_update:
-            self.database_manager.update_database(translations_to_update, overwrite_translations)
+        try:
+            self.translate_rows_by_lang(rows_by_lang, duplicates, batch_size, overwrite_translations)
+        finally:
+            # The examples are only needed while the rows of the range are being sent
+            self.fuzzy_examples.clear()
+
+    def translate_rows_by_lang(self, rows_by_lang, duplicates, batch_size, overwrite_translations):
+        # Translate the rows of every language with the worker pool and store each batch as it finishes;
+        # duplicates maps each language to the rows that get the same translation as a row that is sent
+
+        # Batches are cut only when they are about to be sent, so they follow the latest batch budget
+        # batch_size is the maximum number of rows in one batch, except for DeepL lists which fill a whole request
+        max_cues = self.get_max_batch_cues(batch_size)
+        scenes = self.get_scenes()
+        if scenes is not None:
+            # Every scene of every language is a unit whose batches run one after another, so each batch
+            # gets the translations before it in the scene as context; the scenes themselves run in parallel
+            scheduler = SceneScheduler([(target_lang, self.get_batch_builder().iter_batches(scene_rows, max_cues))
+                                        for target_lang, rows in rows_by_lang.items()
+                                        for scene_rows in scenes.group_rows(rows)])
+        else:
+            # Without scenes every language is one unit whose batches are all sent as soon as a worker is free
+            scheduler = SceneScheduler([(target_lang, self.get_batch_builder().iter_batches(rows, max_cues))
+                                        for target_lang, rows in rows_by_lang.items()], sequential=False)
 
-    def process_srt(self, overwrite_translations):
+        # Translate up to self.concurrency batches at the same time
+        # Batches are submitted in order, so with a concurrency of 1 every batch sees the previous translation
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = {}
+
+                def submit_next():
+                    # Submit the next batch that may start, returning False when none can start now
+                    while True:
+                        scheduled = scheduler.next_batch()
+                        if scheduled is None:
+                            return False
+                        unit, target_lang, rows_to_translate = scheduled
+                        # Leave out the rows another worker is translating
+                        rows_to_translate = self.claim_batch(rows_to_translate, target_lang,
+                                                             duplicates[target_lang], overwrite_translations)
+                        if not rows_to_translate:
+                            scheduler.finished(unit)
+                            continue
+                        print(f"Translating lines {rows_to_translate[0][0]}-{rows_to_translate[-1][0]} ({target_lang})...")
+                        future = executor.submit(self.translate_batch, rows_to_translate, overwrite_translations,
+                                                 target_lang)
+                        futures[future] = (unit, target_lang, rows_to_translate)
+                        return True
+
+                # Keep every worker busy without queueing batches far ahead
+                while len(futures) < self.concurrency and submit_next():
+                    pass
+
+                # Collect the results as the batches finish, in whatever order that happens
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    future = next(iter(done))
+                    unit, target_lang, rows_to_translate = futures.pop(future)
+                    # The next batch of the scene can start now, since the worker already added this batch's
+                    # translations to the context window; fill every free worker again
+                    scheduler.finished(unit)
+                    while len(futures) < self.concurrency and submit_next():
+                        pass
+                    try:
+                        results, failed_rows = future.result()
+                    except Exception as e:
+                        print(f"Error translating lines {rows_to_translate[0][0]}-{rows_to_translate[-1][0]} "
+                              f"({target_lang}): {e}")
+                        results, failed_rows = [], rows_to_translate
+
+                    # The rows whose attempts all failed are recorded as failed, together with their duplicates
+                    self.metrics.increment('cues_failed', len(failed_rows))
+                    failed_indices = [row[0] for row in failed_rows]
+                    for row in failed_rows:
+                        failed_indices.extend(duplicates[target_lang].get(row[0], []))
+
+                    # Remember the new translations in the cache
+                    if results and self.translation_cache is not None:
+                        source_texts = {row[0]: row[1] for row in rows_to_translate}
+                        self.translation_cache.put_many(
+                            [(source_texts[subtitle_index], block) for subtitle_index, block in results],
+                            target_lang, self.translation_service, self.get_model_name())
+
+                    # Give rows with the same text the same translation
+                    for subtitle_index, block in results[:]:
+                        results.extend((duplicate_index, block)
+                                       for duplicate_index in duplicates[target_lang].get(subtitle_index, []))
+
+                    # Store the batch as soon as it is finished; the results carry their own subtitle indices,
+                    # so the completion order does not matter
+                    self.metrics.increment('cues_translated', len(results))
+                    with self.metrics.stage('database_update'):
+                        self.database_manager.finish_batch(results, failed_indices, overwrite_translations,
+                                                           target_lang)
+        finally:
+            # Rows that were claimed but not finished, for example after Ctrl-C, are handed back at once
+            self.database_manager.release_leases(self.worker_id)
+
+    def claim_batch(self, rows_to_translate, target_lang, duplicates, overwrite_translations):
+        # Lease the rows of a batch and their duplicates, and return the rows this translator now holds.
+        # Duplicates held by another worker are removed from duplicates, so they are not written twice.
+        indices = [row[0] for row in rows_to_translate]
+        for row in rows_to_translate:
+            indices.extend(duplicates.get(row[0], []))
+        claimed = self.database_manager.claim_rows(indices, self.worker_id, self.lease_seconds,
+                                                   overwrite_translations, target_lang)
+        for row in rows_to_translate:
+            if row[0] in duplicates:
+                duplicates[row[0]] = [index for index in duplicates[row[0]] if index in claimed]
+        return [row for row in rows_to_translate if row[0] in claimed]
+
+    def get_failed_translations(self):
+        # Return the (target_lang, index) pairs in the selected index ranges whose last attempt failed
+        ranges = [tuple(map(int, index_range.split('-'))) for index_range in self.index_range]
+        return [(target_lang, index) for target_lang, index
+                in self.database_manager.get_failed_translations(self.target_langs)
+                if any(start <= index <= end for start, end in ranges)]
+
+    def process_srt(self, overwrite_translations, retry_failed=None):
+        # retry_failed decides whether failed translations are retried; None asks the user
         # Announce the start of the translation process
         print("\nStarting translation...\n")
+        self.metrics.labels['service'] = self.translation_service
+        usage_before = self.get_usage_stats()
 
         try:
             # Loop through each index range specified by the user
@@ -396,34 +884,244 @@ class Translator:
                 # Call the function to process and translate the range of subtitles
                 self.process_and_translate_range(start_index, end_index, self.batch_size, overwrite_translations)
 
-            # Once all ranges have been processed, create the translated SRT file
-            self.create_translated_srt()
-
             # If there were any failed translations, attempt to retranslate them
+            # Failures are kept in the database, so this also retries the failures of an interrupted run
+            failed_translations = self.get_failed_translations()
             if failed_translations:
                 print(f"Indexes of failed translations before retranslation: {failed_translations}")
-                # Copy the list of failed translations for reprocessing
-                temp_failed_translations = failed_translations[:]
-                # Clear the original list before attempting retranslation
-                failed_translations.clear()
 
                 # Ask the user if they want to retry translating the failed ones
-                retry = input("Do you want to try retranslating the failed translations? (y/n): ")
-                if retry.lower() == 'y':
-                    # Retry translation for each failed index
-                    for index in temp_failed_translations:
-                        self.process_and_translate_range(index, index, 1, overwrite_translations)
+                if retry_failed is None:
+                    retry = input("Do you want to try retranslating the failed translations? (y/n): ")
+                    retry_failed = retry.lower() == 'y'
+                if retry_failed:
+                    # Retry translation for each failed index in the language it failed in
+                    for target_lang, index in failed_translations:
+                        self.process_and_translate_range(index, index, 1, overwrite_translations, [target_lang])
                 else:
                     # If the user decides not to retry, you can add a message or take other actions
                     print("Not retrying failed translations. Continuing with the next steps.")
 
                 # After retrying, check if there are still any failed translations
+                failed_translations = self.get_failed_translations()
                 if failed_translations:
                     print(f"Indexes of failed translations after retranslation: {failed_translations}")
                 else:
                     # If all retranslations succeeded, notify the user
                     print("All retranslations succeeded, the list of failures is now empty.")
 
+            # Check the finished translations and translate the outliers again; the SRT file is written
+            # even if the QA pass fails
+            if self.qa:
+                try:
+                    self.run_qa()
+                except Exception as e:
+                    print(f"Error in the QA pass: {e}")
+
+            # Once all ranges and retries have been processed, create the translated SRT file
+            self.create_translated_srt()
+
+            # Show how much work the translation cache saved and how the batches were sized
+            if self.translation_cache is not None:
+                print(self.translation_cache.report())
+            if self.fuzzy_memory is not None:
+                print(self.fuzzy_memory.report())
+            print(self.get_batch_builder().report())
+            if usage_before is not None:
+                print(self.prompt_cache_report(usage_before))
+            if self.retry_stats['retried_batches']:
+                print(self.retry_report())
+
         except ValueError:
             # Catch and handle any ValueError, typically from incorrect input formats
             print("Invalid input.")
+
+        # Return the indices that are still untranslated
+        return self.get_failed_translations()
+
+    def run_qa(self):
+        # Check every language's finished track and send the subtitles it flags once more
+        if not subtitle_qa.is_available():
+            print("Skipping the QA pass: it needs NumPy (pip install numpy).")
+            return
+        ranges = [tuple(map(int, index_range.split('-'))) for index_range in self.index_range]
+        for target_lang in self.target_langs:
+            qa_rows = self.database_manager.get_qa_rows(target_lang)
+            if not qa_rows[0]:
+                # Nothing was translated into this language, for example because every request failed
+                print(f"Skipping the QA pass for '{target_lang}': there are no translations to check.")
+                continue
+            with self.metrics.stage('qa'):
+                result = subtitle_qa.check_translations(*qa_rows, limits=self.qa_limits)
+            print(subtitle_qa.report(result, target_lang))
+
+            # Only the subtitles in the selected ranges are sent again
+            requeue = [index for index in result['requeue'] if any(start <= index <= end for start, end in ranges)]
+            if not requeue:
+                continue
+            self.metrics.increment('qa_requeued', len(requeue))
+            print(f"Translating {len(requeue)} subtitles flagged by the QA pass again ({target_lang})...")
+            self.retranslate(requeue, target_lang)
+            with self.metrics.stage('qa'):
+                result = subtitle_qa.check_translations(*self.database_manager.get_qa_rows(target_lang),
+                                                        limits=self.qa_limits)
+            print("After translating again: " + subtitle_qa.report(result, target_lang))
+
+    def retranslate(self, indices, target_lang, chunk_size=500):
+        # Replace the translations of the given subtitles, bypassing the translation cache that produced them;
+        # a subtitle whose new translation fails keeps its earlier one
+        for start in range(0, len(indices), chunk_size):
+            chunk = indices[start:start + chunk_size]
+            rows = self.database_manager.get_original_texts(chunk)
+            self.context_window.add_sources(rows)
+            self.translate_rows_by_lang({target_lang: rows}, {target_lang: {}}, self.batch_size, True)
+            self.database_manager.keep_translations(chunk, target_lang)
+
+    def collect_pending_rows(self, overwrite_translations):
+        # Gather the rows of every index range and language that still need translating,
+        # after filling in cached translations and collapsing repeated texts
+        rows_by_lang = {}
+        duplicates_by_lang = {}
+        for target_lang in self.target_langs:
+            rows = []
+            for index_range in self.index_range:
+                start_index, end_index = map(int, index_range.split('-'))
+                rows.extend(self.database_manager.fetch_rows_to_translate(start_index, end_index,
+                                                                          overwrite_translations, target_lang) or [])
+                # The translations stored before each range are the only context a batch job can use
+                self.context_window.add(target_lang, self.database_manager.get_translations_before(
+                    start_index, self.context_window.size, target_lang))
+
+            rows, cached_translations, duplicates = self.apply_translation_cache(rows, overwrite_translations,
+                                                                                 target_lang)
+            if cached_translations:
+                self.database_manager.update_database(cached_translations, overwrite_translations, target_lang)
+            rows_by_lang[target_lang] = rows
+            duplicates_by_lang[target_lang] = duplicates
+        return rows_by_lang, duplicates_by_lang
+
+    def submit_batch_job(self, rows_by_lang, duplicates_by_lang):
+        # Send all the batches as one batch job, such as an OpenAI Batch API job, and store it in the database;
+        # returns the job id
+        provider = self.get_provider()
+        requests = []
+        job_requests = []
+        scenes = self.get_scenes()
+        for target_lang, rows in rows_by_lang.items():
+            # Batches do not run across a scene break, like in process_and_translate_range
+            groups = scenes.group_rows(rows) if scenes is not None else [rows]
+            batches = (batch for group in groups for batch in self.batch_builder.iter_batches(group, self.batch_size))
+            for batch in batches:
+                custom_id = f"{target_lang}-{len(requests) + 1}"
+                requests.append(provider.build_batch_request(
+                    custom_id, encode_batch(batch), target_lang, self.movie_name,
+                    self.get_context(batch[0][0], target_lang), tagged=True,
+                    examples=self.get_examples(batch, target_lang),
+                    system_prompt=self.get_system_prompt(target_lang, True)))
+                # The payload remembers which subtitles the request covers and which rows share their text
+                payload = {"rows": [row[0] for row in batch],
+                           "duplicates": {str(row[0]): duplicates_by_lang[target_lang][row[0]]
+                                          for row in batch if row[0] in duplicates_by_lang[target_lang]}}
+                job_requests.append((custom_id, target_lang, json.dumps(payload)))
+
+        if not requests:
+            print("Nothing left to translate.")
+            return None
+
+        try:
+            job_id = provider.submit_batch(requests)
+        except Exception as e:
+            print(f"Error submitting batch job: {e}")
+            return None
+        self.database_manager.save_batch_job(job_id, job_requests)
+        print(f"Submitted batch job {job_id} with {len(requests)} requests.")
+        return job_id
+
+    def apply_batch_job(self, job_id, output_file_id, overwrite_translations):
+        # Store the translations of a finished job; returns the rows that are still untranslated,
+        # in the (rows_by_lang, duplicates_by_lang) form submit_batch_job takes
+        outputs = self.get_provider().download_batch_results(output_file_id)
+        failed_rows = {}
+        failed_duplicates = {}
+        for custom_id, target_lang, payload in self.database_manager.get_batch_job_requests(job_id):
+            payload = json.loads(payload)
+            duplicates = {int(index): indices for index, indices in payload["duplicates"].items()}
+            rows = self.database_manager.get_original_texts(payload["rows"])
+            translated_text = outputs.get(custom_id)
+            if translated_text:
+                results, missing_rows = decode_batch(translated_text, rows)
+            else:
+                results, missing_rows = [], rows
+
+            failed_indices = [row[0] for row in missing_rows]
+            if missing_rows:
+                failed_rows.setdefault(target_lang, []).extend(missing_rows)
+                failed_duplicates.setdefault(target_lang, {}).update(duplicates)
+                for row in missing_rows:
+                    failed_indices.extend(duplicates.get(row[0], []))
+            if not results:
+                self.database_manager.finish_batch([], failed_indices, overwrite_translations, target_lang)
+                continue
+
+            # Remember the new translations in the cache
+            if self.translation_cache is not None:
+                source_texts = {row[0]: row[1] for row in rows}
+                self.translation_cache.put_many(
+                    [(source_texts[subtitle_index], block) for subtitle_index, block in results],
+                    target_lang, self.translation_service, self.get_model_name())
+
+            # Give rows with the same text the same translation
+            for subtitle_index, block in results[:]:
+                results.extend((duplicate_index, block) for duplicate_index in duplicates.get(subtitle_index, []))
+            self.database_manager.finish_batch(results, failed_indices, overwrite_translations, target_lang)
+
+        self.database_manager.set_batch_job_status(job_id, 'applied')
+        return failed_rows, failed_duplicates
+
+    def run_batch_job(self, overwrite_translations, wait_for_results=True, poll_interval=30, requeue_rounds=2):
+        # Translate the whole file with the OpenAI Batch API instead of live requests.
+        # A job that was submitted earlier is resumed; otherwise the pending rows are submitted as a new job.
+        # Rows missing from the results are submitted again, up to requeue_rounds more times.
+        # Returns the id of a job that is still running when wait_for_results is False, otherwise None.
+        if not hasattr(self.get_provider(), 'submit_batch'):
+            print(f"Batch jobs are not available with {self.translation_service}.")
+            return None
+
+        job_id = self.database_manager.get_open_batch_job()
+        if job_id:
+            print(f"Resuming batch job {job_id}...")
+        else:
+            job_id = self.submit_batch_job(*self.collect_pending_rows(overwrite_translations))
+            # Rows sent again after the job get no examples, so they are not kept while waiting
+            self.fuzzy_examples.clear()
+
+        rounds = 0
+        while job_id:
+            try:
+                job = self.get_provider().retrieve_batch(job_id)
+            except Exception as e:
+                print(f"Error checking batch job {job_id}: {e}")
+                return job_id
+            self.database_manager.set_batch_job_status(job_id, job.status)
+
+            if job.status in ('validating', 'in_progress', 'finalizing', 'cancelling'):
+                if not wait_for_results:
+                    print(f"Batch job {job_id} is {job.status}. Run again later to apply the results.")
+                    return job_id
+                time.sleep(poll_interval)
+                continue
+
+            # Completed, expired and cancelled jobs may all have results for some of the requests
+            print(f"Batch job {job_id} is {job.status}.")
+            failed_rows, failed_duplicates = self.apply_batch_job(job_id, getattr(job, 'output_file_id', None),
+                                                                  overwrite_translations)
+            failed_count = sum(len(rows) for rows in failed_rows.values())
+            job_id = None
+            if failed_count:
+                print(f"{failed_count} subtitles were not translated by the batch job.")
+                if rounds < requeue_rounds:
+                    rounds += 1
+                    job_id = self.submit_batch_job(failed_rows, failed_duplicates)
+
+        self.create_translated_srt()
+        return None